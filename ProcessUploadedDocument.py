@@ -10,18 +10,61 @@ import logging
 import os
 import io
 import json
-import uuid
+import hashlib
 import traceback
+from contextlib import ExitStack, contextmanager
 from datetime import datetime
 from azure.ai.documentintelligence import DocumentIntelligenceClient
 from azure.core.credentials import AzureKeyCredential
 from azure.storage.blob import BlobServiceClient
 from openai import AzureOpenAI
 from azure.search.documents import SearchClient
+from artifact_store import get_artifact_store
+from concurrency import get_concurrency_metrics, get_limiter
+from failure_store import (DocumentProcessingError, clear_failure, get_failure, is_transient_error, load_artifacts,
+                           record_failure)
+from index_pointer import resolve_embedding_deployment, resolve_index_name, resolve_index_target, resolve_write_targets
+from near_duplicates import LshTable, get_near_duplicate_index, minhash_signature
+from spreadsheets import SPREADSHEET_EXTENSIONS, iter_spreadsheet_chunks
 
 # Create the blueprint
 ProcessUploadedDocument = func.Blueprint()
 
+SUPPORTED_EXTENSIONS = ['.pdf', '.docx', '.doc', '.pptx', '.ppt', '.xlsx', '.xls']
+
+# Chunking settings, in tokens of the embedding model's encoding
+CHUNK_TOKENS = int(os.environ.get("CHUNK_TOKENS", "512"))
+CHUNK_OVERLAP_TOKENS = int(os.environ.get("CHUNK_OVERLAP_TOKENS", "64"))
+EMBEDDING_ENCODING = "cl100k_base"
+
+DOCUMENT_INTELLIGENCE_MODEL = "prebuilt-layout"
+
+# Maximum number of inputs sent in one embeddings request
+EMBEDDING_BATCH_SIZE = int(os.environ.get("EMBEDDING_BATCH_SIZE", "16"))
+
+# Azure AI Search takes at most 1000 documents and 16 MB per indexing
+# request; stay under both, with headroom for the request envelope
+SEARCH_BATCH_DOCUMENTS = int(os.environ.get("SEARCH_BATCH_DOCUMENTS", "1000"))
+SEARCH_BATCH_BYTES = int(os.environ.get("SEARCH_BATCH_BYTES", str(12 * 1024 * 1024)))
+
+# Spreadsheet chunks are embedded and indexed in groups of this size so
+# large sheets never sit in memory all at once
+SPREADSHEET_BATCH_CHUNKS = int(os.environ.get("SPREADSHEET_BATCH_CHUNKS", "256"))
+
+# How long a blob invocation waits for a documents slot before handing the
+# blob back to the host for a retry; the wait counts against functionTimeout
+DOCUMENT_SLOT_TIMEOUT_SECONDS = float(os.environ.get("DOCUMENT_SLOT_TIMEOUT_SECONDS", "120"))
+
+class IndexingError(Exception):
+    """Azure AI Search rejected some documents of an indexing request"""
+
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    def __reduce__(self):
+        return type(self), (str(self), self.status_code)
+
 @ProcessUploadedDocument.blob_trigger(arg_name="myblob", path="knowledge-docs/{name}",
                                connection="aligndataengineering_STORAGE") 
 def process_uploaded_document(myblob: func.InputStream):
@@ -32,47 +75,295 @@ def process_uploaded_document(myblob: func.InputStream):
     try:
         # Log start of processing
         logging.info(f"=== STARTING PROCESSING FOR: {myblob.name} ===")
+        targets = resolve_write_targets()
+        index_name, deployment_name = targets[0]
         
         # 1. Read document from blob storage
-        document_bytes = myblob.read()
+        read_artifacts = {"index_name": index_name, "deployment_name": deployment_name}
+        with pipeline_stage(myblob.name, "read", read_artifacts):
+            document_bytes = myblob.read()
         logging.info(f"Successfully read {len(document_bytes)} bytes from blob")
+        read_artifacts["content_hash"] = hashlib.sha256(document_bytes).hexdigest()
         
-        # Check if this is a PDF or other supported document type
-        file_extension = os.path.splitext(myblob.name)[1].lower()
-        supported_extensions = ['.pdf', '.docx', '.doc', '.pptx', '.ppt', '.xlsx', '.xls']
-        
-        if file_extension not in supported_extensions:
-            logging.warning(f"Unsupported file type: {file_extension}. Skipping processing.")
-            return
-        
-        logging.info(f"File extension {file_extension} is supported, proceeding with processing")
-            
-        # 2. Process document with Document Intelligence
-        logging.info("Starting Document Intelligence analysis")
-        extracted_text = analyze_document(document_bytes)
-        
-        if not extracted_text or len(extracted_text.strip()) == 0:
-            logging.warning(f"No text extracted from document: {myblob.name}. Skipping further processing.")
-            return
-        
-        logging.info(f"Successfully extracted {len(extracted_text)} characters of text")
-            
-        # 3. Generate embeddings using Azure OpenAI
-        logging.info("Starting embedding generation with Azure OpenAI")
-        embeddings = generate_embeddings(extracted_text)
-        logging.info(f"Successfully generated embeddings with dimension: {len(embeddings)}")
-        
-        # 4. Create search document and add to Azure AI Search
-        logging.info("Adding document to Azure AI Search")
-        add_to_search_index(myblob.name, extracted_text, embeddings)
-        
-        logging.info(f"=== SUCCESSFULLY PROCESSED DOCUMENT: {myblob.name} ===")
+        # host.json's maxDegreeOfParallelism is only a ceiling; the adaptive
+        # documents limit decides how many are actually in flight
+        with ExitStack() as slot:
+            try:
+                slot.enter_context(get_limiter("documents").acquire(timeout=DOCUMENT_SLOT_TIMEOUT_SECONDS))
+            except TimeoutError as e:
+                # Recorded as a read failure so the blob shows up in replay.py even if
+                # the host's retries run out; an earlier failure keeps its artifacts
+                if get_failure(myblob.name, index_name) is None:
+                    raise DocumentProcessingError(myblob.name, "read", e, read_artifacts) from e
+                raise
+            process_or_resume(myblob.name, document_bytes, index_name, deployment_name)
+            clear_failure(myblob.name, index_name)
+            for shadow_index, shadow_deployment in targets[1:]:
+                write_shadow_copy(myblob.name, document_bytes, shadow_index, shadow_deployment)
     
     except Exception as e:
         logging.error(f"Error processing document {myblob.name}: {str(e)}")
         logging.error(f"Traceback: {traceback.format_exc()}")
-        # Consider storing failed documents info in a separate container or queue
+        # Keep what already succeeded in the failure store so a retry resumes from
+        # the failed stage. Transient errors are raised for the host to retry (up to
+        # its dequeue count); anything else would fail again and waits for replay.py
+        recorded = isinstance(e, DocumentProcessingError) and record_failure(e)
+        if recorded and not is_transient_error(e):
+            return
+        raise
+
+@ProcessUploadedDocument.route(route="concurrency", methods=["GET"], auth_level=func.AuthLevel.FUNCTION)
+def concurrency_metrics(req: func.HttpRequest) -> func.HttpResponse:
+    """Current adaptive concurrency limits of this instance"""
+    return func.HttpResponse(json.dumps(get_concurrency_metrics()), mimetype="application/json")
+
+def resolve_target(index_name=None, deployment_name=None):
+    """Fill in the live index and deployment for whichever of the two is not given"""
+    if index_name and deployment_name:
+        return index_name, deployment_name
+    live_index, live_deployment = resolve_index_target()
+    return index_name or live_index, deployment_name or live_deployment
+
+def process_or_resume(doc_name, document_bytes, index_name, deployment_name):
+    """Process a document, resuming from its recorded failure if the content is unchanged"""
+    record = get_failure(doc_name, index_name)
+    if record:
+        artifacts = load_artifacts(record)
+        if artifacts.get("content_hash") == hashlib.sha256(document_bytes).hexdigest():
+            logging.info(f"Resuming {doc_name} from its recorded {record['stage']} failure")
+            return resume_document(doc_name, record["stage"], artifacts, document_bytes)
+    return process_document(doc_name, document_bytes, index_name, deployment_name)
+
+def write_shadow_copy(doc_name, document_bytes, index_name, deployment_name):
+    """Index a document into the shadow index being built as well.
+    
+    Failures are recorded rather than raised: a host retry would redo the
+    live index, while replay.py or the next build run picks this one up.
+    """
+    logging.info(f"Also indexing {doc_name} into shadow index {index_name}")
+    try:
+        process_or_resume(doc_name, document_bytes, index_name, deployment_name)
+    except DocumentProcessingError as e:
+        logging.error(f"Shadow index {index_name} failed for {doc_name}: {str(e)}")
+        record_failure(e)
+        return
+    clear_failure(doc_name, index_name)
+
+@contextmanager
+def pipeline_stage(doc_name, stage, artifacts):
+    """Wrap errors raised inside a stage in a DocumentProcessingError"""
+    try:
+        yield
+    except DocumentProcessingError:
         raise
+    except Exception as e:
+        raise DocumentProcessingError(doc_name, stage, e, artifacts) from e
+
+def process_document(doc_name, document_bytes, index_name=None, deployment_name=None, resume_artifacts=None):
+    """Run the analyze, chunk, embed and index steps for a single document.
+
+    Shared by the blob trigger and the backfill CLI. index_name and
+    deployment_name override the live index pointer, which is how a shadow
+    index is built. Returns the number of chunks indexed (0 when the
+    document was skipped). Failures are raised as DocumentProcessingError.
+    
+    The live target is resolved once here and passed down, so a switch
+    while the document is in flight cannot mix deployments in one index.
+    """
+    index_name, deployment_name = resolve_target(index_name, deployment_name)
+    
+    # Check if this is a PDF or other supported document type
+    file_extension = os.path.splitext(doc_name)[1].lower()
+    
+    if file_extension not in SUPPORTED_EXTENSIONS:
+        logging.warning(f"Unsupported file type: {file_extension}. Skipping processing.")
+        return 0
+    
+    logging.info(f"File extension {file_extension} is supported, proceeding with processing")
+    
+    if file_extension in SPREADSHEET_EXTENSIONS:
+        return process_spreadsheet(doc_name, document_bytes, index_name, deployment_name, resume_artifacts)
+    
+    # content_hash lets a retry check that saved artifacts still match the document
+    artifacts = {"index_name": index_name, "deployment_name": deployment_name,
+                 "content_hash": hashlib.sha256(document_bytes).hexdigest()}
+        
+    # 2. Process document with Document Intelligence
+    logging.info("Starting Document Intelligence analysis")
+    with pipeline_stage(doc_name, "analyze", artifacts):
+        extracted_text = analyze_document_cached(document_bytes)
+    
+    if not extracted_text or len(extracted_text.strip()) == 0:
+        logging.warning(f"No text extracted from document: {doc_name}. Skipping further processing.")
+        # Saved so resuming this index stage knows there is nothing to upload
+        artifacts.update(chunks=[], chunk_indexes=[], embeddings=[])
+        with pipeline_stage(doc_name, "index", artifacts):
+            delete_stale_chunks(doc_name, [], index_name)
+        return 0
+    
+    logging.info(f"Successfully extracted {len(extracted_text)} characters of text")
+    artifacts["text"] = extracted_text
+    
+    indexed = index_text(doc_name, extracted_text, artifacts)
+    
+    logging.info(f"=== SUCCESSFULLY PROCESSED DOCUMENT: {doc_name} ===")
+    return indexed
+
+def index_text(doc_name, text, artifacts):
+    """Chunk extracted text, then embed and index the chunks"""
+    # 3. Split the text into chunks that fit the embedding model
+    with pipeline_stage(doc_name, "chunk", artifacts):
+        chunks = chunk_text(text)
+    logging.info(f"Split document into {len(chunks)} chunks")
+        
+    # 4 and 5. Embed the chunks and add them to Azure AI Search
+    indexed = index_chunks(doc_name, chunks, 0, artifacts)
+    with pipeline_stage(doc_name, "index", artifacts):
+        delete_stale_chunks(doc_name, artifacts["chunk_indexes"], artifacts.get("index_name"))
+    return indexed
+
+def process_spreadsheet(doc_name, document_bytes, index_name=None, deployment_name=None, resume_artifacts=None):
+    """Index a workbook from locally parsed row-group chunks, one batch at a time.
+    
+    When resuming a failed run, batches before the failed one are skipped
+    and vectors already computed for the failed batch are reused.
+    """
+    resume_artifacts = resume_artifacts or {}
+    skip_chunks = resume_artifacts.get("start_index", 0)
+    # Index failures saved every embedding; embed failures saved those computed before the failing request
+    known_vectors = dict(zip(resume_artifacts.get("chunk_indexes") or [], resume_artifacts.get("embeddings") or []))
+    artifacts = {"index_name": index_name, "deployment_name": deployment_name,
+                 "content_hash": hashlib.sha256(document_bytes).hexdigest()}
+    
+    # Positions written to the index, so leftovers from a longer version can be removed
+    indexed_positions = list(range(skip_chunks))
+    
+    def index_batch(batch, start_index):
+        artifacts.update(start_index=start_index, chunk_indexes=None, embeddings=None)
+        count = index_chunks(doc_name, batch, start_index, artifacts, known_vectors)
+        indexed_positions.extend(artifacts["chunk_indexes"])
+        return count
+    
+    # 2 and 3. Parse the workbook locally into row-group chunks
+    logging.info("Reading workbook locally instead of calling Document Intelligence")
+    indexed = 0
+    start_index = 0
+    batch = []
+    chunk_iter = iter_spreadsheet_chunks(doc_name, document_bytes)
+    while True:
+        with pipeline_stage(doc_name, "analyze", artifacts):
+            chunk = next(chunk_iter, None)
+        if chunk is None:
+            break
+        if start_index < skip_chunks:
+            # Indexed before the run that failed
+            start_index += 1
+            continue
+        batch.append(chunk)
+        if len(batch) >= SPREADSHEET_BATCH_CHUNKS:
+            indexed += index_batch(batch, start_index)
+            start_index += len(batch)
+            batch = []
+    if batch:
+        indexed += index_batch(batch, start_index)
+        start_index += len(batch)
+    
+    with pipeline_stage(doc_name, "index", artifacts):
+        delete_stale_chunks(doc_name, indexed_positions, index_name)
+    
+    if start_index == 0:
+        logging.warning(f"No rows found in workbook: {doc_name}. Skipping further processing.")
+        return 0
+    
+    logging.info(f"=== SUCCESSFULLY PROCESSED WORKBOOK: {doc_name} ({start_index} chunks) ===")
+    return indexed
+
+def index_chunks(doc_name, chunks, start_index, artifacts, known_vectors=None):
+    """Embed chunks and add them to the search index; returns the number indexed.
+    
+    start_index is the position of chunks[0] within the document, which keeps
+    search keys stable when a document is indexed in several batches.
+    known_vectors maps chunk positions to vectors that need no embedding call.
+    artifacts carries the target index and deployment and collects the
+    intermediate results saved if a stage fails.
+    """
+    index_name = artifacts.get("index_name")
+    deployment_name = artifacts.get("deployment_name")
+    artifacts.update(chunks=chunks, start_index=start_index)
+    
+    # 4. Generate embeddings using Azure OpenAI, skipping near-duplicate chunks
+    logging.info(f"Starting embedding generation with Azure OpenAI for {len(chunks)} chunks")
+    with pipeline_stage(doc_name, "embed", artifacts):
+        try:
+            chunk_indexes, embeddings, on_indexed = embed_chunks(doc_name, chunks, index_name, deployment_name,
+                                                                 start_index, known_vectors)
+        except Exception as e:
+            # Saved with the failure so a resume does not pay for these vectors again; they
+            # are dropped from the error itself, which may be pickled to another process
+            partial_vectors = vars(e).pop("partial_vectors", None)
+            vars(e).pop("partial_embeddings", None)
+            if partial_vectors:
+                artifacts.update(chunk_indexes=sorted(partial_vectors),
+                                 embeddings=[partial_vectors[i] for i in sorted(partial_vectors)])
+            raise
+    artifacts.update(chunk_indexes=chunk_indexes, embeddings=embeddings)
+    
+    # 5. Create search documents and add to Azure AI Search
+    logging.info("Adding document chunks to Azure AI Search")
+    with pipeline_stage(doc_name, "index", artifacts):
+        add_chunks_to_search_index(doc_name, [chunks[i - start_index] for i in chunk_indexes], embeddings,
+                                   index_name, chunk_indexes)
+    
+    try:
+        on_indexed()
+    except Exception as e:
+        # The chunks are indexed; missing dedup records only cost a future embedding
+        logging.warning(f"Could not record near-duplicate index entries for {doc_name}: {str(e)}")
+    return len(chunk_indexes)
+
+def resume_document(doc_name, stage, artifacts, document_bytes=None):
+    """Re-run a failed document from the stage that failed, reusing saved artifacts"""
+    index_name, deployment_name = resolve_target(artifacts.get("index_name"), artifacts.get("deployment_name"))
+    
+    if resume_needs_source(doc_name, stage):
+        return process_document(doc_name, document_bytes, index_name, deployment_name, artifacts)
+    
+    resumed = {"index_name": index_name, "deployment_name": deployment_name,
+               "content_hash": artifacts.get("content_hash")}
+    if stage == "chunk":
+        resumed["text"] = artifacts["text"]
+        return index_text(doc_name, artifacts["text"], resumed)
+    
+    # Index failures saved every embedding; embed failures saved those computed before the failing request
+    known_vectors = dict(zip(artifacts.get("chunk_indexes") or [], artifacts.get("embeddings") or []))
+    # No chunks means the document had no text and only its stale entries were left to delete
+    indexed = index_chunks(doc_name, artifacts.get("chunks") or [], artifacts.get("start_index", 0), resumed,
+                           known_vectors)
+    with pipeline_stage(doc_name, "index", resumed):
+        delete_stale_chunks(doc_name, resumed["chunk_indexes"], index_name)
+    return indexed
+
+def resume_needs_source(doc_name, stage):
+    """Whether resuming from stage has to read the original document again"""
+    file_extension = os.path.splitext(doc_name)[1].lower()
+    return stage in ("read", "analyze") or file_extension in SPREADSHEET_EXTENSIONS
+
+def analyze_document_cached(document_bytes):
+    """Analyze document, reusing a cached extraction of identical bytes if one exists"""
+    store = get_artifact_store()
+    if store is None:
+        return analyze_document(document_bytes)
+    
+    content_hash = hashlib.sha256(document_bytes).hexdigest()
+    cache_key = f"extractions/{DOCUMENT_INTELLIGENCE_MODEL}/{content_hash}.txt"
+    cached = store.get(cache_key)
+    if cached is not None:
+        logging.info(f"Using cached extraction {cache_key}")
+        return cached.decode("utf-8")
+    
+    text_content = analyze_document(document_bytes)
+    store.put(cache_key, text_content.encode("utf-8"))
+    return text_content
 
 def analyze_document(document_bytes):
     """Analyze document using Azure Document Intelligence"""
@@ -86,7 +377,8 @@ def analyze_document(document_bytes):
         logging.info(f"Creating Document Intelligence client with endpoint: {endpoint}")
         document_intelligence_client = DocumentIntelligenceClient(
             endpoint=endpoint, 
-            credential=AzureKeyCredential(key)
+            credential=AzureKeyCredential(key),
+            raw_response_hook=lambda response: report_throttling("analyze", response.http_response.status_code)
         )
         
         logging.info("Sending document to Azure Document Intelligence for analysis")
@@ -97,13 +389,14 @@ def analyze_document(document_bytes):
             bytes_source=document_bytes
         )
         
-        poller = document_intelligence_client.begin_analyze_document(
-            model_id="prebuilt-layout",
-            analyze_request=analyze_request
-        )
-        
-        logging.info("Waiting for document analysis to complete")
-        result = poller.result()
+        with get_limiter("analyze").acquire():
+            poller = document_intelligence_client.begin_analyze_document(
+                model_id=DOCUMENT_INTELLIGENCE_MODEL,
+                analyze_request=analyze_request
+            )
+            
+            logging.info("Waiting for document analysis to complete")
+            result = poller.result()
         
         # Extract text from the document
         text_content = ""
@@ -118,51 +411,245 @@ def analyze_document(document_bytes):
         logging.error(traceback.format_exc())
         raise
 
-def generate_embeddings(text):
-    """Generate embeddings using Azure OpenAI"""
-    endpoint = os.environ["AZURE_OPENAI_ENDPOINT"]
-    api_key = os.environ["AZURE_OPENAI_KEY"]
-    deployment_name = os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"]
+def chunk_text(text):
+    """Split text into overlapping chunks of at most CHUNK_TOKENS tokens"""
+    import tiktoken
+    
+    encoding = tiktoken.get_encoding(EMBEDDING_ENCODING)
+    tokens = encoding.encode(text)
+    
+    step = max(CHUNK_TOKENS - CHUNK_OVERLAP_TOKENS, 1)
+    chunks = []
+    for start in range(0, len(tokens), step):
+        chunk = encoding.decode(tokens[start:start + CHUNK_TOKENS])
+        if chunk.strip():
+            chunks.append(chunk)
+        if start + CHUNK_TOKENS >= len(tokens):
+            break
     
-    client = AzureOpenAI(
-        api_key=api_key,
+    return chunks
+
+def report_throttling(stage, status_code):
+    """Response hook: tell the stage's limiter about each 429, including ones the SDK retries"""
+    if status_code == 429:
+        get_limiter(stage).record_throttle()
+
+def get_openai_client():
+    """Create an Azure OpenAI client from the app settings"""
+    import httpx
+    
+    return AzureOpenAI(
+        api_key=os.environ["AZURE_OPENAI_KEY"],
         api_version="2023-05-15",
-        azure_endpoint=endpoint
+        azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+        # Event hooks run once per attempt, inside the client's own retry loop
+        http_client=httpx.Client(event_hooks={
+            "response": [lambda response: report_throttling("embed", response.status_code)]})
     )
+
+def generate_embeddings(text, deployment_name=None):
+    """Generate embeddings using Azure OpenAI"""
+    return generate_embeddings_batch([text], deployment_name)[0]
+
+def generate_embeddings_batch(texts, deployment_name=None):
+    """Generate embeddings for a list of texts, EMBEDDING_BATCH_SIZE inputs per request.
     
-    response = client.embeddings.create(
-        input=text,
-        model=deployment_name
-    )
+    If a request fails, the raised error carries the embeddings of the
+    requests before it as partial_embeddings.
+    """
+    deployment_name = deployment_name or resolve_embedding_deployment()
+    client = get_openai_client()
+    
+    embeddings = []
+    for start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+        batch = texts[start:start + EMBEDDING_BATCH_SIZE]
+        try:
+            # Latency grows with the number of inputs, so the limiter compares it per input
+            with get_limiter("embed").acquire(cost=len(batch)):
+                response = client.embeddings.create(
+                    input=batch,
+                    model=deployment_name
+                )
+        except Exception as e:
+            e.partial_embeddings = embeddings
+            raise
+        # The service does not guarantee ordering, so sort by input index
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
     
-    return response.data[0].embedding
+    return embeddings
 
-def add_to_search_index(doc_name, content, embeddings):
-    """Add document to Azure AI Search index"""
-    search_endpoint = os.environ["AZURE_AISEARCH_ENDPOINT"]
-    search_key = os.environ["AZURE_AISEARCH_KEY"]
-    index_name = os.environ["SEARCH_INDEX_NAME"]
-    
-    # Create search client
-    search_client = SearchClient(
-        endpoint=search_endpoint,
-        index_name=index_name,
-        credential=AzureKeyCredential(search_key)
-    )
+def embed_chunks(doc_name, chunks, index_name=None, deployment_name=None, start_index=0, known_vectors=None):
+    """Embed chunks, reusing the vectors of near-duplicate chunks already indexed.
+    
+    Returns the document-wide indexes (offset by start_index) of the chunks
+    to upload, their embeddings, and a callback that records the new chunks
+    as canonical once they are indexed. Chunks found in known_vectors are
+    not embedded again. Every chunk is still indexed with its own text; only
+    the embedding call is skipped.
+    """
+    index_name = index_name or resolve_index_name()
+    deployment_name = deployment_name or resolve_embedding_deployment()
+    dedup_index = get_near_duplicate_index(index_name, deployment_name)
+    
+    known_vectors = known_vectors or {}
+    positions = range(start_index, start_index + len(chunks))
+    vectors = {i: known_vectors[i] for i in positions if i in known_vectors}
+    pending = [i for i in positions if i not in vectors]
+    
+    if dedup_index is None:
+        if pending:
+            embeddings = embed_positions(chunks, pending, start_index, deployment_name, vectors)
+            logging.info(f"Successfully generated {len(embeddings)} embeddings with dimension: {len(embeddings[0])}")
+        chunk_indexes = sorted(vectors)
+        return chunk_indexes, [vectors[i] for i in chunk_indexes], lambda: None
     
-    # Generate a unique document ID
-    doc_id = str(uuid.uuid4())
+    canonical_ids = {}
+    # Known vectors were embedded by an earlier attempt that never got to record them
+    signatures = {i: minhash_signature(chunks[i - start_index]) for i in vectors}
+    # Chunks of this call that become canonical, so pending chunks can match each other too
+    batch = LshTable(dedup_index.threshold)
+    for chunk_index, signature in signatures.items():
+        if signature:
+            batch.insert(chunk_index, signature)
+    to_embed = []
+    twins = {}
+    for chunk_index in pending:
+        signature = minhash_signature(chunks[chunk_index - start_index])
+        canonical_id, vector, twin = None, None, None
+        if signature:
+            canonical_id, similarity = dedup_index.find(signature)
+            vector = dedup_index.get_vector(canonical_id) if canonical_id else None
+            if vector is None:
+                twin, similarity = batch.find(signature)
+                canonical_id = make_document_id(doc_name, twin) if twin is not None else None
+        if canonical_id is None:
+            signatures[chunk_index] = signature
+            if signature:
+                batch.insert(chunk_index, signature)
+            to_embed.append(chunk_index)
+        elif vector is None:
+            twins[chunk_index] = twin
+        else:
+            vectors[chunk_index] = vector
+            canonical_ids[chunk_index] = canonical_id
     
-    # Create the document - use embeddings directly in a vector field
-    document = {
-        "id": doc_id,
-        "content": content,
-        "fileName": doc_name,
-        "contentVector": embeddings,  # Use embeddings directly without Vector class
-        "processed_dt": datetime.utcnow().isoformat()
-    }
+    if to_embed:
+        embed_positions(chunks, to_embed, start_index, deployment_name, vectors)
+    for chunk_index, twin in twins.items():
+        vectors[chunk_index] = vectors[twin]
+        canonical_ids[chunk_index] = make_document_id(doc_name, twin)
+    logging.info(f"Embedded {len(to_embed)} chunks and reused {len(canonical_ids)} near-duplicate vectors")
+    
+    def on_indexed():
+        for chunk_index in signatures:
+            if signatures[chunk_index]:
+                dedup_index.add(make_document_id(doc_name, chunk_index), chunks[chunk_index - start_index],
+                                signatures[chunk_index], vectors[chunk_index])
+    
+    chunk_indexes = sorted(vectors)
+    return chunk_indexes, [vectors[i] for i in chunk_indexes], on_indexed
+
+def embed_positions(chunks, positions, start_index, deployment_name, vectors):
+    """Embed the chunks at the given document positions into vectors.
+    
+    If embedding fails part way, the error carries every vector known so far
+    as partial_vectors, keyed by position, so a resume can skip them.
+    """
+    try:
+        embeddings = generate_embeddings_batch([chunks[i - start_index] for i in positions], deployment_name)
+    except Exception as e:
+        vectors.update(zip(positions, getattr(e, "partial_embeddings", [])))
+        e.partial_vectors = dict(vectors)
+        raise
+    vectors.update(zip(positions, embeddings))
+    return embeddings
+
+def make_document_id(doc_name, chunk_index):
+    """Build a stable search key so re-processing a document overwrites its chunks"""
+    return hashlib.sha256(f"{doc_name}:{chunk_index}".encode("utf-8")).hexdigest()
+
+def get_search_client(index_name=None):
+    """Create a search client for the given index, or the live one"""
+    return SearchClient(
+        endpoint=os.environ["AZURE_AISEARCH_ENDPOINT"],
+        index_name=index_name or resolve_index_name(),
+        credential=AzureKeyCredential(os.environ["AZURE_AISEARCH_KEY"]),
+        # Runs after the retry policy, so every throttled attempt is seen
+        raw_response_hook=lambda response: report_throttling("index", response.http_response.status_code)
+    )
+
+def add_to_search_index(doc_name, content, embeddings, index_name=None):
+    """Add document to Azure AI Search index"""
+    add_chunks_to_search_index(doc_name, [content], [embeddings], index_name)
+
+def add_chunks_to_search_index(doc_name, chunks, embeddings, index_name=None, chunk_indexes=None):
+    """Add one search document per chunk to the Azure AI Search index"""
+    if not chunks:
+        logging.info(f"Document {doc_name} has no new chunks to index")
+        return
+    if chunk_indexes is None:
+        chunk_indexes = range(len(chunks))
+    search_client = get_search_client(index_name)
+    processed_dt = datetime.utcnow().isoformat()
+    
+    # Create the documents - use embeddings directly in a vector field
+    documents = [
+        {
+            "id": make_document_id(doc_name, chunk_index),
+            "content": chunk,
+            "fileName": doc_name,
+            "contentVector": vector,  # Use embeddings directly without Vector class
+            "processed_dt": processed_dt
+        }
+        for chunk_index, chunk, vector in zip(chunk_indexes, chunks, embeddings)
+    ]
     
     # Upload to search index
-    search_client.upload_documents([document])
+    send_index_actions(search_client, "upload_documents", documents)
+    
+    logging.info(f"Document {doc_name} indexed as {len(documents)} chunks")
+
+def iter_index_batches(documents):
+    """Group search documents into requests within SEARCH_BATCH_DOCUMENTS and SEARCH_BATCH_BYTES"""
+    batch = []
+    batch_bytes = 0
+    for document in documents:
+        size = len(json.dumps(document))
+        if batch and (len(batch) >= SEARCH_BATCH_DOCUMENTS or batch_bytes + size > SEARCH_BATCH_BYTES):
+            yield batch
+            batch, batch_bytes = [], 0
+        batch.append(document)
+        batch_bytes += size
+    if batch:
+        yield batch
+
+def send_index_actions(search_client, action, documents):
+    """Run upload_documents or delete_documents in batches, raising IndexingError on any rejected document"""
+    for batch in iter_index_batches(documents):
+        with get_limiter("index").acquire():
+            results = getattr(search_client, action)(documents=batch)
+            # A 207 reports rejected documents per item instead of failing the request
+            failed = [result for result in results if not result.succeeded]
+            if failed:
+                # The lowest status decides: a 400 among 503s will not pass on retry
+                raise IndexingError(f"{action} rejected {len(failed)} of {len(batch)} documents, "
+                                    f"first {failed[0].key}: {failed[0].error_message}",
+                                    min(result.status_code for result in failed))
+
+def delete_stale_chunks(doc_name, chunk_indexes, index_name=None):
+    """Delete the document's search entries that the latest run did not write.
+    
+    Covers chunks past the end of a document that got shorter and entries
+    written under older key schemes. Requires fileName to be filterable.
+    """
+    keep_ids = {make_document_id(doc_name, chunk_index) for chunk_index in chunk_indexes}
+    search_client = get_search_client(index_name)
+    escaped_name = doc_name.replace("'", "''")
+    
+    with get_limiter("index").acquire():
+        results = search_client.search(search_text="*", filter=f"fileName eq '{escaped_name}'", select=["id"])
+        stale = [{"id": result["id"]} for result in results if result["id"] not in keep_ids]
     
-    logging.info(f"Document {doc_name} indexed with ID {doc_id}")
\ No newline at end of file
+    if stale:
+        send_index_actions(search_client, "delete_documents", stale)
+        logging.info(f"Deleted {len(stale)} stale chunks of {doc_name}")
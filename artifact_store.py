@@ -0,0 +1,118 @@
+"""Small key/value store for pipeline artifacts shared across invocations.
+
+Backed by a blob container (ARTIFACT_STORE_CONTAINER, using the function
+app's storage connection) or, for local runs, a directory
+(ARTIFACT_STORE_DIR). When neither is set, get_artifact_store() returns
+None and callers skip whatever they would have cached.
+"""
+
+import logging
+import os
+import tempfile
+
+STORAGE_CONNECTION_SETTING = "aligndataengineering_STORAGE"
+
+_store = None
+
+class LocalArtifactStore:
+    """Artifacts as files under a root directory"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split("/"))
+
+    def get(self, key):
+        try:
+            with open(self._path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, key, data):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write then rename so readers never see a partial artifact
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def version(self, key):
+        """Changes whenever the artifact is rewritten; None if it does not exist"""
+        try:
+            return str(os.stat(self._path(key)).st_mtime_ns)
+        except FileNotFoundError:
+            return None
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix=""):
+        keys = []
+        for root, _, files in os.walk(self.root):
+            for file_name in files:
+                key = os.path.relpath(os.path.join(root, file_name), self.root).replace(os.sep, "/")
+                if key.startswith(prefix) and not file_name.startswith(".tmp-"):
+                    keys.append(key)
+        return sorted(keys)
+
+class BlobArtifactStore:
+    """Artifacts as blobs in a storage container"""
+
+    def __init__(self, container_name):
+        from azure.storage.blob import BlobServiceClient
+
+        connection_string = os.environ[STORAGE_CONNECTION_SETTING]
+        self.container_client = BlobServiceClient.from_connection_string(
+            connection_string).get_container_client(container_name)
+        if not self.container_client.exists():
+            self.container_client.create_container()
+
+    def get(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return self.container_client.download_blob(key).readall()
+        except ResourceNotFoundError:
+            return None
+
+    def put(self, key, data):
+        self.container_client.upload_blob(key, data, overwrite=True)
+
+    def version(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            return self.container_client.get_blob_client(key).get_blob_properties().etag
+        except ResourceNotFoundError:
+            return None
+
+    def delete(self, key):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        try:
+            self.container_client.delete_blob(key)
+        except ResourceNotFoundError:
+            pass
+
+    def list(self, prefix=""):
+        return [blob.name for blob in self.container_client.list_blobs(name_starts_with=prefix)]
+
+def get_artifact_store():
+    """Return the configured artifact store, or None if none is configured"""
+    global _store
+    if _store is None:
+        container_name = os.environ.get("ARTIFACT_STORE_CONTAINER")
+        directory = os.environ.get("ARTIFACT_STORE_DIR")
+        if container_name:
+            logging.info(f"Using blob artifact store in container {container_name}")
+            _store = BlobArtifactStore(container_name)
+        elif directory:
+            logging.info(f"Using local artifact store in {directory}")
+            _store = LocalArtifactStore(directory)
+    return _store
@@ -0,0 +1,331 @@
+"""Bulk backfill / reindex for every document in a container.
+
+Lists the knowledge-docs container (or a local directory standing in for it)
+and pushes each document through the same analyze, chunk, embed and index
+steps as the blob trigger, using a thread or process pool.
+
+Examples:
+    python backfill.py --dry-run
+    python backfill.py --workers 16 --checkpoint reindex.checkpoint
+    python backfill.py --source-dir ./docs --executor process
+"""
+
+import argparse
+import io
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import zipfile
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+from concurrency import get_concurrency_metrics, get_limiter
+
+DEFAULT_CONTAINER = "knowledge-docs"
+STORAGE_CONNECTION_SETTING = "aligndataengineering_STORAGE"
+
+# Rough extraction yield used by --dry-run, since text is unknown until analysis
+DEFAULT_TOKENS_PER_PAGE = 500
+
+def load_local_settings(path):
+    """Load the Values section of local.settings.json into the environment"""
+    if not path or not os.path.exists(path):
+        return
+    with open(path) as f:
+        settings = json.load(f)
+        for key, value in settings.get('Values', {}).items():
+            os.environ.setdefault(key, value)
+
+def get_container_client(container_name):
+    """Create a container client from the function app's storage connection string"""
+    from azure.storage.blob import BlobServiceClient
+
+    connection_string = os.environ[STORAGE_CONNECTION_SETTING]
+    return BlobServiceClient.from_connection_string(connection_string).get_container_client(container_name)
+
+def list_documents(source_dir=None, container_name=DEFAULT_CONTAINER):
+    """Return (doc_name, size, version) for every document in the source.
+
+    doc_name matches the blob trigger's myblob.name ("<container>/<blob>") so
+    reindexed chunks overwrite the ones written by the trigger. version is
+    the blob's etag (a file's modification time locally) and changes
+    whenever the document is rewritten.
+    """
+    if source_dir:
+        documents = []
+        for root, _, files in os.walk(source_dir):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                rel_path = os.path.relpath(path, source_dir).replace(os.sep, "/")
+                stat = os.stat(path)
+                documents.append((f"{container_name}/{rel_path}", stat.st_size, str(stat.st_mtime_ns)))
+        return sorted(documents)
+
+    container_client = get_container_client(container_name)
+    return [(f"{container_name}/{blob.name}", blob.size, blob.etag) for blob in container_client.list_blobs()]
+
+def read_document(doc_name, source_dir=None):
+    """Read a document's bytes from the local directory or blob container"""
+    container_name, blob_name = doc_name.split("/", 1)
+    if source_dir:
+        with open(os.path.join(source_dir, *blob_name.split("/")), "rb") as f:
+            return f.read()
+    return get_container_client(container_name).download_blob(blob_name).readall()
+
+def backfill_document(doc_name, source_dir=None, index_name=None, deployment_name=None):
+    """Worker entry point: read one document and run it through the pipeline"""
+    # Imported here so process-pool workers load the pipeline themselves
+    from ProcessUploadedDocument import pipeline_stage, process_or_resume, resolve_target
+    from failure_store import DocumentProcessingError, clear_failure, record_failure
+
+    index_name, deployment_name = resolve_target(index_name, deployment_name)
+    try:
+        with pipeline_stage(doc_name, "read", {"index_name": index_name, "deployment_name": deployment_name}):
+            document_bytes = read_document(doc_name, source_dir)
+        with get_limiter("documents").acquire():
+            chunks = process_or_resume(doc_name, document_bytes, index_name, deployment_name)
+    except DocumentProcessingError as e:
+        # Saved so replay.py can resume from the failed stage
+        record_failure(e)
+        raise
+    clear_failure(doc_name, index_name)
+    return chunks
+
+def pdf_object_bodies(document_bytes):
+    """The raw file followed by the decompressed contents of its object streams"""
+    yield document_bytes
+    # PDF 1.5+ can keep page objects inside compressed object streams
+    for match in re.finditer(rb"<<[^>]*/Type\s*/ObjStm[^>]*>>\s*stream\r?\n", document_bytes):
+        try:
+            yield zlib.decompressobj().decompress(document_bytes[match.end():])
+        except zlib.error:
+            continue
+
+def estimate_pages(doc_name, document_bytes):
+    """Estimate page count without calling Document Intelligence"""
+    extension = os.path.splitext(doc_name)[1].lower()
+    if extension == ".pdf":
+        page_objects = 0
+        page_count = 0
+        for body in pdf_object_bodies(document_bytes):
+            # The root /Pages node's /Count is the page total; page objects are the fallback
+            for node in re.findall(rb"<<[^<>]*/Type\s*/Pages(?![a-zA-Z])[^<>]*>>", body):
+                count = re.search(rb"/Count\s+(\d+)", node)
+                if count:
+                    page_count = max(page_count, int(count.group(1)))
+            page_objects += len(re.findall(rb"/Type\s*/Page(?![a-zA-Z])", body))
+        return max(page_count or page_objects, 1)
+    if extension in (".docx", ".pptx"):
+        # Word and PowerPoint record the page or slide count in the document properties
+        try:
+            with zipfile.ZipFile(io.BytesIO(document_bytes)) as archive:
+                properties = archive.read("docProps/app.xml")
+        except (zipfile.BadZipFile, KeyError):
+            return 1
+        match = re.search(rb"<(?:\w+:)?(?:Pages|Slides)>(\d+)<", properties)
+        return max(int(match.group(1)), 1) if match else 1
+    # Legacy binary formats need a full parse to paginate; count them as one page
+    return 1
+
+def estimate_spreadsheet_tokens(doc_name, document_bytes):
+    """Embedding tokens of a workbook, from the chunks it parses into locally"""
+    from spreadsheets import iter_spreadsheet_chunks
+
+    # Same 4 characters per token the chunk budget assumes
+    return sum(len(chunk) for chunk in iter_spreadsheet_chunks(doc_name, document_bytes)) // 4
+
+def dry_run(documents, source_dir, tokens_per_page):
+    """Print the page and embedding token estimate for the pending documents"""
+    from ProcessUploadedDocument import SPREADSHEET_EXTENSIONS, SUPPORTED_EXTENSIONS
+
+    supported = [(name, size) for name, size, _ in documents
+                 if os.path.splitext(name)[1].lower() in SUPPORTED_EXTENSIONS]
+    spreadsheets = [name for name, _ in supported if os.path.splitext(name)[1].lower() in SPREADSHEET_EXTENSIONS]
+    total_pages = 0
+    spreadsheet_tokens = 0
+    for doc_name, _ in supported:
+        if doc_name in spreadsheets:
+            # Workbooks are parsed locally and never reach Document Intelligence
+            spreadsheet_tokens += estimate_spreadsheet_tokens(doc_name, read_document(doc_name, source_dir))
+        elif os.path.splitext(doc_name)[1].lower() in (".pdf", ".docx", ".pptx"):
+            total_pages += estimate_pages(doc_name, read_document(doc_name, source_dir))
+        else:
+            total_pages += 1
+
+    print(f"Documents pending:     {len(documents)}")
+    print(f"Supported documents:   {len(supported)}")
+    print(f"Total size:            {sum(size for _, size in supported) / (1024 * 1024):.1f} MB")
+    print(f"Estimated pages:       {total_pages} (Document Intelligence prebuilt-layout, excluding spreadsheets)")
+    print(f"Estimated tokens:      {total_pages * tokens_per_page + spreadsheet_tokens} (embedding input, "
+          f"{tokens_per_page} tokens/page plus {spreadsheet_tokens} from {len(spreadsheets)} parsed spreadsheets)")
+
+class Checkpoint:
+    """Append-only record of the document versions that finished, so reruns skip them.
+
+    Each line is "<doc_name>\t<version>"; a document rewritten since it was
+    checkpointed has a new version and is processed again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    doc_name, _, version = line.rstrip("\n").rpartition("\t")
+                    if doc_name and version:
+                        self.completed[doc_name] = version
+                    elif doc_name:
+                        # Written by forget()
+                        self.completed.pop(doc_name, None)
+
+    def is_done(self, doc_name, version):
+        return self.completed.get(doc_name) == version
+
+    def mark_done(self, doc_name, version):
+        with self._lock:
+            self.completed[doc_name] = version
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(f"{doc_name}\t{version}\n")
+
+    def forget(self, doc_name):
+        """Drop a document that no longer exists in the source"""
+        with self._lock:
+            self.completed.pop(doc_name, None)
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write(f"{doc_name}\t\n")
+
+class Progress:
+    """Periodic throughput line on stderr"""
+
+    def __init__(self, total, interval=5.0):
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.failed = 0
+        self.chunks = 0
+        self.started = time.monotonic()
+        self._last_report = 0.0
+
+    def update(self, chunks=0, failed=False):
+        if failed:
+            self.failed += 1
+        else:
+            self.done += 1
+            self.chunks += chunks
+        now = time.monotonic()
+        if now - self._last_report >= self.interval or self.done + self.failed == self.total:
+            self._last_report = now
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        finished = self.done + self.failed
+        rate = finished / elapsed
+        eta = (self.total - finished) / rate if rate else 0
+        # Limits live in the worker processes when --executor process is used
+        limits = " ".join(f"{name}={m['limit']}" for name, m in get_concurrency_metrics().items())
+        print(f"[{finished}/{self.total}] {self.done} ok, {self.failed} failed | "
+              f"{rate:.2f} docs/s, {self.chunks / elapsed:.1f} chunks/s | "
+              f"elapsed {elapsed:.0f}s, eta {eta:.0f}s" + (f" | limits {limits}" if limits else ""),
+              file=sys.stderr, flush=True)
+
+def run_backfill(documents, source_dir=None, workers=None, executor="thread", checkpoint=None,
+                 index_name=None, deployment_name=None):
+    """Process documents in parallel and return the list of failed document names.
+
+    index_name and deployment_name default to the live index pointer.
+    """
+    checkpoint = checkpoint or Checkpoint(None)
+    pending = [(name, version) for name, _, version in documents if not checkpoint.is_done(name, version)]
+    progress = Progress(len(pending))
+    failed = []
+
+    if not pending:
+        print(f"Nothing to do: every document is unchanged since it was recorded in {checkpoint.path}; "
+              f"pass another --checkpoint to reprocess them", file=sys.stderr)
+        return failed
+
+    pool_class = ProcessPoolExecutor if executor == "process" else ThreadPoolExecutor
+    with pool_class(max_workers=workers) as pool:
+        futures = {pool.submit(backfill_document, name, source_dir, index_name, deployment_name): (name, version)
+                   for name, version in pending}
+        for future in as_completed(futures):
+            doc_name, version = futures[future]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                logging.error(f"Backfill failed for {doc_name}: {str(e)}")
+                failed.append(doc_name)
+                progress.update(failed=True)
+                continue
+            checkpoint.mark_done(doc_name, version)
+            progress.update(chunks=chunks)
+
+    return failed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Reindex every document in a container")
+    parser.add_argument("--container", default=DEFAULT_CONTAINER,
+                        help="Blob container to list (default: %(default)s)")
+    parser.add_argument("--source-dir",
+                        help="Read documents from a local directory instead of blob storage")
+    parser.add_argument("--workers", type=int, default=(os.cpu_count() or 1) * 4,
+                        help="Upper bound on documents in flight; the adaptive limit "
+                             "decides the actual number (default: %(default)s)")
+    parser.add_argument("--executor", choices=["thread", "process"], default="thread",
+                        help="Pool type; the pipeline is mostly network-bound (default: %(default)s)")
+    parser.add_argument("--checkpoint",
+                        help="File recording completed documents, used to resume (default: "
+                             "backfill.checkpoint, or backfill-<index>.checkpoint with --index)")
+    parser.add_argument("--index",
+                        help="Write to this search index instead of the live one")
+    parser.add_argument("--deployment",
+                        help="Embedding deployment to use instead of the live one (requires a shadow --index)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only estimate pages and tokens for the pending documents")
+    parser.add_argument("--tokens-per-page", type=int, default=DEFAULT_TOKENS_PER_PAGE,
+                        help="Token estimate per page for --dry-run (default: %(default)s)")
+    parser.add_argument("--settings", default="local.settings.json",
+                        help="Settings file to load into the environment if present")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    load_local_settings(args.settings)
+    if args.deployment:
+        from index_pointer import resolve_index_target
+
+        live_index, live_deployment = resolve_index_target()
+        if args.deployment != live_deployment and args.index in (None, live_index):
+            # The live index must only hold vectors of the deployment the pointer names
+            parser.error("--deployment needs --index naming a shadow index, not the live one")
+    os.environ.setdefault("CONCURRENCY_MAX_DOCUMENTS", str(args.workers))
+
+    # Each target index tracks its own progress; a shared file would skip documents it never got
+    checkpoint = Checkpoint(args.checkpoint or (f"backfill-{args.index}.checkpoint" if args.index
+                                                else "backfill.checkpoint"))
+    documents = list_documents(args.source_dir, args.container)
+    documents = [document for document in documents if not checkpoint.is_done(document[0], document[2])]
+
+    if args.dry_run:
+        dry_run(documents, args.source_dir, args.tokens_per_page)
+        return 0
+
+    failed = run_backfill(documents, args.source_dir, args.workers, args.executor, checkpoint,
+                          args.index, args.deployment)
+    if failed:
+        print(f"{len(failed)} documents failed; rerun to retry them:", file=sys.stderr)
+        for doc_name in failed:
+            print(f"  {doc_name}", file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
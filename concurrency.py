@@ -0,0 +1,193 @@
+"""Adaptive concurrency limits for documents and per-stage service calls.
+
+The embed stage gets a Vegas-style limit. It tracks the no-load latency
+(the lowest recently observed) and estimates how many requests are queueing
+at the service from limit * (1 - no_load / latency). The limit grows while
+that queue is short and shrinks once it gets long. An embedding request
+carries anywhere from one input to EMBEDDING_BATCH_SIZE, so callers pass the
+input count as the call's cost and latency is compared per input.
+
+Analyze and index latency follows the payload (pages, batch size), and
+whole-document latency follows document size, so the analyze, index and
+documents limits ignore latency. They grow by one for every limit-sized
+round of successful calls (AIMD).
+
+Every limit halves when a call is throttled (429), at most once per latency
+window, and never grows while less than half of it is in use. The SDK
+clients retry 429s on their own, so they report every throttled response
+through record_throttle() as well, not just calls that ran out of retries.
+Calls that fail for other reasons free their slot without adjusting the
+limit.
+
+Limits are per process. Current values are logged every
+CONCURRENCY_LOG_SECONDS and returned by get_concurrency_metrics().
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# (initial, maximum) in-flight limit per stage; CONCURRENCY_MAX_<STAGE> overrides the maximum
+DEFAULT_LIMITS = {
+    "documents": (4, 32),
+    "analyze": (4, 16),
+    "embed": (4, 32),
+    "index": (4, 16),
+}
+
+# Stages whose call latency does not depend on the payload
+LATENCY_SENSITIVE_STAGES = {"embed"}
+
+CONCURRENCY_LOG_SECONDS = float(os.environ.get("CONCURRENCY_LOG_SECONDS", "60"))
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_last_logged = 0.0
+
+def is_throttling_error(error):
+    """Whether an error, or anything in its cause chain, is an HTTP 429"""
+    while error is not None:
+        if getattr(error, "status_code", None) == 429 or type(error).__name__ == "RateLimitError":
+            return True
+        error = getattr(error, "cause", None) or error.__cause__
+    return False
+
+class AdaptiveLimit:
+    """Concurrency limit adjusted from observed latency and throttling"""
+
+    def __init__(self, name, initial, min_limit=1, max_limit=64, latency_sensitive=True):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_sensitive = latency_sensitive
+        self.in_flight = 0
+        self.no_load_rtt = None
+        self.last_rtt = None
+        self.completed = 0
+        self.throttled = 0
+        self.failed = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def acquire(self, timeout=None, cost=1):
+        """Hold one in-flight slot for the duration of the block.
+
+        cost is the size of the call's payload; latency-sensitive limits
+        divide the call's latency by it. Raises TimeoutError if no slot frees
+        up within timeout seconds.
+        """
+        with self._condition:
+            if not self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout):
+                raise TimeoutError(f"No {self.name} slot free within {timeout}s (limit {int(self.limit)})")
+            self.in_flight += 1
+        started = time.monotonic()
+        sampled = throttled = False
+        try:
+            yield
+            sampled = True
+        except Exception as e:
+            # Only successes and throttling say anything about the service's capacity;
+            # a fast failure (bad input, auth) would read as an idle service
+            throttled = sampled = is_throttling_error(e)
+            raise
+        finally:
+            with self._condition:
+                if sampled:
+                    self._update(time.monotonic() - started, throttled, cost)
+                else:
+                    self.failed += 1
+                self.in_flight -= 1
+                self._condition.notify_all()
+            log_concurrency_metrics()
+
+    def record_throttle(self):
+        """Count a 429 response that the client retries without raising"""
+        with self._condition:
+            self._throttle(self.last_rtt or 0.0)
+
+    def _throttle(self, rtt):
+        self.throttled += 1
+        # One halving per latency window, so a burst of 429s counts as one signal
+        if time.monotonic() - self._last_decrease >= rtt:
+            self._last_decrease = time.monotonic()
+            self.limit = max(self.min_limit, self.limit / 2)
+
+    def _update(self, rtt, throttled, cost=1):
+        # Called with the slot still counted in in_flight
+        self.completed += 1
+        self.last_rtt = rtt
+        if throttled:
+            self._throttle(rtt)
+            return
+
+        # Latency per unit of payload, which is what no_load_rtt tracks
+        rtt = rtt / max(cost, 1)
+        if self.latency_sensitive:
+            # Follow a lower latency at once and drift up slowly, so the
+            # no-load estimate survives a service that got slower for good
+            if self.no_load_rtt is None or rtt < self.no_load_rtt:
+                self.no_load_rtt = rtt
+            else:
+                self.no_load_rtt = 0.999 * self.no_load_rtt + 0.001 * rtt
+
+        if self.in_flight * 2 < self.limit:
+            # Not enough demand to tell whether a higher limit would help
+            return
+
+        step = max(1.0, math.log10(self.limit))
+        if not self.latency_sensitive:
+            new_limit = self.limit + 1 / self.limit
+        else:
+            queue = self.limit * (1 - self.no_load_rtt / rtt) if rtt > 0 else 0
+            if queue <= 3 * step:
+                new_limit = self.limit + step / self.limit
+            elif queue >= 6 * step:
+                new_limit = self.limit - step / self.limit
+            else:
+                new_limit = self.limit
+        self.limit = max(self.min_limit, min(self.max_limit, new_limit))
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "limit": int(self.limit),
+                "in_flight": self.in_flight,
+                # Per unit of cost, e.g. per embedding input
+                "no_load_rtt_ms": round(self.no_load_rtt * 1000, 1) if self.no_load_rtt else None,
+                "last_rtt_ms": round(self.last_rtt * 1000) if self.last_rtt else None,
+                "completed": self.completed,
+                "throttled": self.throttled,
+                "failed": self.failed,
+            }
+
+def get_limiter(name):
+    """Shared limiter for a stage ("documents", "analyze", "embed" or "index")"""
+    with _limiters_lock:
+        if name not in _limiters:
+            initial, max_limit = DEFAULT_LIMITS[name]
+            max_limit = int(os.environ.get(f"CONCURRENCY_MAX_{name.upper()}", max_limit))
+            _limiters[name] = AdaptiveLimit(name, min(initial, max_limit), max_limit=max_limit,
+                                            latency_sensitive=(name in LATENCY_SENSITIVE_STAGES))
+        return _limiters[name]
+
+def get_concurrency_metrics():
+    """Current limit, in-flight count and latency per stage"""
+    with _limiters_lock:
+        limiters = list(_limiters.values())
+    return {limiter.name: limiter.metrics() for limiter in limiters}
+
+def log_concurrency_metrics(force=False):
+    """Log the current limits, at most every CONCURRENCY_LOG_SECONDS"""
+    global _last_logged
+    now = time.monotonic()
+    if not force and now - _last_logged < CONCURRENCY_LOG_SECONDS:
+        return
+    _last_logged = now
+    summary = ", ".join(f"{name}={m['limit']} (in flight {m['in_flight']}, throttled {m['throttled']})"
+                        for name, m in get_concurrency_metrics().items())
+    logging.info(f"Concurrency limits: {summary}")
@@ -0,0 +1,138 @@
+"""Dead-letter store for documents that failed part-way through the pipeline.
+
+A failure record notes the stage that failed, the error class and message,
+and points at the intermediate artifacts already produced (extracted text,
+chunks, embeddings), so replay.py can resume from the failed stage instead
+of starting over. A transient failure (throttling, timeouts, 5xx) is also
+retried by the caller, and the retry resumes from the record as long as the
+document's content has not changed. Records live in the artifact store:
+
+    failures/records/<id>.json      small record used for listing and filtering
+    failures/artifacts/<id>.json    intermediate artifacts, read only on replay
+"""
+
+import hashlib
+import json
+import logging
+import pickle
+import traceback
+from datetime import datetime
+
+from artifact_store import get_artifact_store
+
+STAGES = ["read", "analyze", "chunk", "embed", "index"]
+
+RECORDS_PREFIX = "failures/records/"
+ARTIFACTS_PREFIX = "failures/artifacts/"
+
+# SDK exceptions for throttling, timeouts and dropped connections (openai, azure-core)
+TRANSIENT_ERROR_CLASSES = {"RateLimitError", "APITimeoutError", "APIConnectionError", "InternalServerError",
+                           "ServiceRequestError", "ServiceResponseError"}
+
+class DocumentProcessingError(Exception):
+    """A pipeline stage failed; carries what earlier stages already produced"""
+
+    def __init__(self, doc_name, stage, cause, artifacts=None):
+        super().__init__(f"{stage} failed for {doc_name}: {cause}")
+        self.doc_name = doc_name
+        self.stage = stage
+        self.cause = cause
+        self.artifacts = dict(artifacts or {})
+
+    def __reduce__(self):
+        # Crosses process boundaries (backfill --executor process) without the
+        # artifacts, which the worker has already recorded and can be large
+        try:
+            pickle.dumps(self.cause)
+            cause = self.cause
+        except Exception:
+            cause = RuntimeError(f"{type(self.cause).__name__}: {self.cause}")
+        return type(self), (self.doc_name, self.stage, cause)
+
+def is_transient_error(error):
+    """Whether an error, or anything in its cause chain, is likely to pass on retry"""
+    while error is not None:
+        status_code = getattr(error, "status_code", None)
+        if status_code in (408, 429) or (isinstance(status_code, int) and status_code >= 500):
+            return True
+        if isinstance(error, (TimeoutError, ConnectionError)):
+            return True
+        if type(error).__name__ in TRANSIENT_ERROR_CLASSES:
+            return True
+        error = getattr(error, "cause", None) or error.__cause__
+    return False
+
+def failure_id(doc_name, index_name=None):
+    return hashlib.sha256(f"{index_name or ''}:{doc_name}".encode("utf-8")).hexdigest()
+
+def record_failure(error):
+    """Store a DocumentProcessingError; returns False when no artifact store is configured"""
+    store = get_artifact_store()
+    if store is None:
+        return False
+
+    index_name = error.artifacts.get("index_name")
+    key = failure_id(error.doc_name, index_name)
+    previous = store.get(RECORDS_PREFIX + key + ".json")
+    attempts = json.loads(previous)["attempts"] + 1 if previous else 1
+
+    record = {
+        "id": key,
+        "fileName": error.doc_name,
+        "stage": error.stage,
+        "error_class": type(error.cause).__name__,
+        "error_message": str(error.cause),
+        "traceback": "".join(traceback.format_exception(type(error.cause), error.cause, error.cause.__traceback__)),
+        "index_name": index_name,
+        "deployment_name": error.artifacts.get("deployment_name"),
+        "artifacts": sorted(name for name, value in error.artifacts.items() if value is not None),
+        "attempts": attempts,
+        "failed_dt": datetime.utcnow().isoformat()
+    }
+    store.put(ARTIFACTS_PREFIX + key + ".json", json.dumps(error.artifacts).encode("utf-8"))
+    store.put(RECORDS_PREFIX + key + ".json", json.dumps(record, indent=2).encode("utf-8"))
+    logging.warning(f"Recorded {error.stage} failure for {error.doc_name} (attempt {attempts})")
+    return True
+
+def get_failure(doc_name, index_name=None):
+    """A document's failure record, or None if it has none"""
+    store = get_artifact_store()
+    if store is None:
+        return None
+    data = store.get(RECORDS_PREFIX + failure_id(doc_name, index_name) + ".json")
+    return json.loads(data) if data else None
+
+def load_artifacts(record):
+    """Intermediate artifacts saved with a failure record"""
+    data = get_artifact_store().get(ARTIFACTS_PREFIX + record["id"] + ".json")
+    return json.loads(data) if data else {}
+
+def list_failures(stage=None, error_class=None):
+    """Failure records, optionally filtered by stage and error class"""
+    store = get_artifact_store()
+    if store is None:
+        return []
+
+    records = []
+    for key in store.list(RECORDS_PREFIX):
+        data = store.get(key)
+        if not data:
+            continue
+        record = json.loads(data)
+        if stage and record["stage"] != stage:
+            continue
+        if error_class and record["error_class"] != error_class:
+            continue
+        records.append(record)
+    return records
+
+def clear_failure(doc_name, index_name=None):
+    """Remove a document's failure record after it processed successfully"""
+    store = get_artifact_store()
+    if store is None:
+        return
+    key = failure_id(doc_name, index_name)
+    if store.get(RECORDS_PREFIX + key + ".json") is None:
+        return
+    store.delete(RECORDS_PREFIX + key + ".json")
+    store.delete(ARTIFACTS_PREFIX + key + ".json")
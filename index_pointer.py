@@ -0,0 +1,125 @@
+"""Config pointer naming the search index (and embedding deployment) in use.
+
+Readers and writers resolve the index through this pointer instead of
+SEARCH_INDEX_NAME directly, so a blue/green swap is a single atomic write
+of "index-pointer.json" in the artifact store. Without an artifact store or
+a pointer, the app settings are used as before.
+
+While a shadow index is being built, the pointer also names it under
+"building" and the blob trigger writes every document to both indexes, so
+the shadow index misses nothing uploaded during or after the build.
+Switching to the shadow index clears "building".
+"""
+
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from artifact_store import get_artifact_store
+
+POINTER_KEY = "index-pointer.json"
+
+# Seconds a resolved pointer is reused before the store is read again
+POINTER_CACHE_SECONDS = float(os.environ.get("INDEX_POINTER_CACHE_SECONDS", "30"))
+
+_cached_pointer = None
+_cached_at = 0.0
+
+def read_index_pointer(use_cache=True):
+    """Return the pointer dict, or None if no pointer has been written"""
+    global _cached_pointer, _cached_at
+    if use_cache and _cached_pointer is not None and time.monotonic() - _cached_at < POINTER_CACHE_SECONDS:
+        return _cached_pointer
+
+    store = get_artifact_store()
+    data = store.get(POINTER_KEY) if store else None
+    pointer = json.loads(data) if data else None
+
+    _cached_pointer, _cached_at = pointer, time.monotonic()
+    return pointer
+
+def _current_pointer():
+    """The stored pointer, or one describing the app settings; requires an artifact store"""
+    store = get_artifact_store()
+    if store is None:
+        raise RuntimeError("An artifact store (ARTIFACT_STORE_CONTAINER or ARTIFACT_STORE_DIR) "
+                           "is required to switch indexes")
+
+    current = read_index_pointer(use_cache=False) or {
+        "index": os.environ["SEARCH_INDEX_NAME"],
+        "deployment": os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"],
+        "previous": []
+    }
+    return store, current
+
+def write_index_pointer(index_name, deployment_name, keep_previous=None):
+    """Point readers and writers at a new index, keeping the old one in history.
+
+    keep_previous trims the rollback history to that many entries. A shadow
+    index being built stays registered unless it is the one switched to.
+    """
+    store, current = _current_pointer()
+    previous = list(current.get("previous", []))
+    if current["index"] != index_name:
+        previous.insert(0, {"index": current["index"], "deployment": current["deployment"]})
+
+    previous = [entry for entry in previous if entry["index"] != index_name]
+    if keep_previous is not None:
+        previous = previous[:keep_previous]
+
+    switched = current["index"] != index_name or current.get("deployment") != deployment_name
+    pointer = {
+        "index": index_name,
+        "deployment": deployment_name,
+        "previous": previous,
+        "switched_dt": datetime.utcnow().isoformat() if switched else current.get("switched_dt")
+    }
+    building = current.get("building")
+    if building and building["index"] != index_name:
+        pointer["building"] = building
+    store.put(POINTER_KEY, json.dumps(pointer, indent=2).encode("utf-8"))
+    if switched:
+        logging.info(f"Search index pointer switched from {current['index']} to {index_name}")
+
+    read_index_pointer(use_cache=False)
+    return pointer
+
+def write_building_index(index_name, deployment_name):
+    """Register (or with index_name None, drop) the shadow index the trigger also writes to"""
+    store, current = _current_pointer()
+    pointer = {key: value for key, value in current.items() if key != "building"}
+    if index_name:
+        pointer["building"] = {"index": index_name, "deployment": deployment_name}
+    store.put(POINTER_KEY, json.dumps(pointer, indent=2).encode("utf-8"))
+    read_index_pointer(use_cache=False)
+    return pointer
+
+def resolve_write_targets():
+    """(index, deployment) pairs new documents go to: the live index, then any shadow being built"""
+    pointer = read_index_pointer()
+    if not pointer:
+        return [(os.environ["SEARCH_INDEX_NAME"], os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"])]
+    targets = [(pointer["index"], pointer["deployment"])]
+    building = pointer.get("building")
+    if building and building["index"] != pointer["index"]:
+        targets.append((building["index"], building["deployment"]))
+    return targets
+
+def resolve_index_target():
+    """(index name, embedding deployment) of the live index, read from one pointer snapshot"""
+    pointer = read_index_pointer()
+    if pointer:
+        return pointer["index"], pointer["deployment"]
+    return os.environ["SEARCH_INDEX_NAME"], os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"]
+
+def resolve_index_name():
+    """Name of the live search index"""
+    pointer = read_index_pointer()
+    return pointer["index"] if pointer else os.environ["SEARCH_INDEX_NAME"]
+
+def resolve_embedding_deployment():
+    """Embedding deployment that produced the live index's vectors"""
+    pointer = read_index_pointer()
+    return pointer["deployment"] if pointer else os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"]
@@ -0,0 +1,313 @@
+"""Blue/green search index swap for re-embedding without touching the live index.
+
+    python index_swap.py status
+    python index_swap.py build   --shadow docs-v2 --deployment text-embedding-3-large --dimensions 3072
+    python index_swap.py compare --shadow docs-v2 --deployment text-embedding-3-large --queries queries.txt
+    python index_swap.py switch  --shadow docs-v2 --deployment text-embedding-3-large [--queries queries.txt --min-recall 0.7]
+    python index_swap.py cancel
+    python index_swap.py gc      [--keep 1]
+
+build copies the live index schema into a shadow index, registers it in
+the index pointer as the index being built, and backfills it. Extractions
+come from the artifact store's cache, so Document Intelligence is only
+called for documents it has not seen. The live index is never written by
+the build, so queries keep hitting a consistent index. From registration
+on, the blob trigger writes new uploads to both indexes. Rerunning build
+reprocesses documents rewritten since the last run (the checkpoint keeps
+each blob's etag) and removes documents deleted from the container.
+
+switch rewrites the index pointer (see index_pointer.py), which readers and
+writers pick up within INDEX_POINTER_CACHE_SECONDS. Writers still holding
+the old pointer keep mirroring into the new index until then. cancel stops
+the mirroring of an abandoned build. gc deletes retired indexes together
+with their near-duplicate records and failure records.
+"""
+
+import argparse
+import logging
+import os
+import statistics
+import sys
+import time
+
+import backfill
+from artifact_store import get_artifact_store
+from failure_store import clear_failure, list_failures
+from index_pointer import (POINTER_CACHE_SECONDS, read_index_pointer, resolve_embedding_deployment, resolve_index_name,
+                           write_building_index, write_index_pointer)
+
+VECTOR_FIELD = "contentVector"
+
+def get_index_client():
+    """Create a search index client from the app settings"""
+    from azure.core.credentials import AzureKeyCredential
+    from azure.search.documents.indexes import SearchIndexClient
+
+    return SearchIndexClient(
+        endpoint=os.environ["AZURE_AISEARCH_ENDPOINT"],
+        credential=AzureKeyCredential(os.environ["AZURE_AISEARCH_KEY"])
+    )
+
+def create_shadow_index(shadow_name, dimensions=None):
+    """Create shadow_name with the live index's schema, resizing the vector field if asked"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    index_client = get_index_client()
+    try:
+        index_client.get_index(shadow_name)
+        logging.info(f"Shadow index {shadow_name} already exists, reusing it")
+        return
+    except ResourceNotFoundError:
+        pass
+
+    index = index_client.get_index(resolve_index_name())
+    index.name = shadow_name
+    index.e_tag = None
+    if dimensions:
+        for field in index.fields:
+            if field.name == VECTOR_FIELD:
+                field.vector_search_dimensions = dimensions
+    index_client.create_index(index)
+    logging.info(f"Created shadow index {shadow_name}")
+
+def build(args):
+    if args.shadow == resolve_index_name():
+        print(f"{args.shadow} is the live index; pick a new name for the shadow index", file=sys.stderr)
+        return 1
+    from ProcessUploadedDocument import delete_stale_chunks
+
+    create_shadow_index(args.shadow, args.dimensions)
+    # From here on the trigger also writes new uploads to the shadow index
+    write_building_index(args.shadow, args.deployment)
+    checkpoint = backfill.Checkpoint(args.checkpoint or f"build-{args.shadow}.checkpoint")
+    documents = backfill.list_documents(args.source_dir, args.container)
+    listed = {name for name, _, _ in documents}
+    for doc_name in [name for name in checkpoint.completed if name not in listed]:
+        # Deleted from the container since an earlier build run indexed it
+        delete_stale_chunks(doc_name, [], args.shadow)
+        checkpoint.forget(doc_name)
+    failed = backfill.run_backfill(documents, args.source_dir, args.workers, args.executor, checkpoint,
+                                   index_name=args.shadow, deployment_name=args.deployment)
+    if failed:
+        print(f"{len(failed)} documents failed; rerun build to retry them", file=sys.stderr)
+        return 1
+    return 0
+
+def search_ids(index_name, deployment_name, query, k):
+    """Return (chunk ids, search latency in seconds) for a vector query"""
+    from azure.search.documents.models import VectorizedQuery
+    from ProcessUploadedDocument import generate_embeddings, get_search_client
+
+    vector = generate_embeddings(query, deployment_name)
+    search_client = get_search_client(index_name)
+    started = time.perf_counter()
+    results = search_client.search(
+        search_text=None,
+        vector_queries=[VectorizedQuery(vector=vector, k_nearest_neighbors=k, fields=VECTOR_FIELD)],
+        select=["id"],
+        top=k
+    )
+    ids = [result["id"] for result in results]
+    return ids, time.perf_counter() - started
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def compare_indexes(shadow_name, shadow_deployment, queries, k=10):
+    """Compare the shadow index against the live one over a query set.
+
+    Recall is the fraction of the live top-k chunks the shadow index also
+    returns in its top-k. Chunk ids are stable across indexes, so this
+    measures how much the new embeddings change what readers get back.
+    """
+    if not queries:
+        raise ValueError("No queries to compare; the queries file is empty")
+    live_name = resolve_index_name()
+    live_deployment = resolve_embedding_deployment()
+    recalls, live_latencies, shadow_latencies = [], [], []
+    for query in queries:
+        live_ids, live_latency = search_ids(live_name, live_deployment, query, k)
+        shadow_ids, shadow_latency = search_ids(shadow_name, shadow_deployment, query, k)
+        live_latencies.append(live_latency)
+        shadow_latencies.append(shadow_latency)
+        if live_ids:
+            recalls.append(len(set(live_ids) & set(shadow_ids)) / len(live_ids))
+
+    report = {
+        "queries": len(queries),
+        "recall_at_k": statistics.mean(recalls) if recalls else 0.0,
+        "live_p50_ms": percentile(live_latencies, 0.5) * 1000,
+        "live_p95_ms": percentile(live_latencies, 0.95) * 1000,
+        "shadow_p50_ms": percentile(shadow_latencies, 0.5) * 1000,
+        "shadow_p95_ms": percentile(shadow_latencies, 0.95) * 1000,
+    }
+    print(f"Live index:    {live_name} ({live_deployment})")
+    print(f"Shadow index:  {shadow_name} ({shadow_deployment})")
+    print(f"Queries:       {report['queries']}")
+    print(f"Recall@{k}:     {report['recall_at_k']:.3f}")
+    print(f"Live latency:  p50 {report['live_p50_ms']:.0f} ms, p95 {report['live_p95_ms']:.0f} ms")
+    print(f"Shadow latency: p50 {report['shadow_p50_ms']:.0f} ms, p95 {report['shadow_p95_ms']:.0f} ms")
+    return report
+
+def load_queries(path):
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip()]
+
+def compare(args):
+    queries = load_queries(args.queries)
+    if not queries:
+        print(f"{args.queries} has no queries", file=sys.stderr)
+        return 1
+    compare_indexes(args.shadow, args.deployment, queries, args.k)
+    return 0
+
+def index_exists(index_name):
+    from azure.core.exceptions import ResourceNotFoundError
+
+    try:
+        get_index_client().get_index(index_name)
+        return True
+    except ResourceNotFoundError:
+        return False
+
+def switch(args):
+    if not index_exists(args.shadow):
+        print(f"Index {args.shadow} does not exist; not switching", file=sys.stderr)
+        return 1
+    if args.queries:
+        queries = load_queries(args.queries)
+        if not queries:
+            print(f"{args.queries} has no queries; not switching", file=sys.stderr)
+            return 1
+        report = compare_indexes(args.shadow, args.deployment, queries, args.k)
+        if args.min_recall is not None and report["recall_at_k"] < args.min_recall:
+            print(f"Recall {report['recall_at_k']:.3f} is below --min-recall {args.min_recall}; not switching",
+                  file=sys.stderr)
+            return 1
+
+    current = read_index_pointer(use_cache=False) or {}
+    target = {"index": args.shadow, "deployment": args.deployment}
+    if current.get("index") != args.shadow and current.get("building") != target:
+        # Writers still holding the old pointer must already mirror into the new index,
+        # or documents they process right after the switch would reach the old one only
+        write_building_index(args.shadow, args.deployment)
+        print(f"Mirroring new documents into {args.shadow}; switching in {POINTER_CACHE_SECONDS:.0f}s",
+              file=sys.stderr)
+        time.sleep(POINTER_CACHE_SECONDS)
+    pointer = write_index_pointer(args.shadow, args.deployment)
+    print(f"Readers and writers now use {pointer['index']} ({pointer['deployment']})")
+    return 0
+
+def cancel(args):
+    """Stop mirroring new documents into an abandoned shadow index"""
+    pointer = read_index_pointer(use_cache=False)
+    if not pointer or not pointer.get("building"):
+        print("No shadow index is being built")
+        return 0
+    write_building_index(None, None)
+    print(f"Stopped writing new documents to {pointer['building']['index']}")
+    return 0
+
+def indexes_to_collect(pointer, keep):
+    """Retired indexes beyond the newest keep, never the live or building one"""
+    protected = {pointer["index"], (pointer.get("building") or {}).get("index")}
+    return [entry["index"] for entry in pointer.get("previous", [])[keep:] if entry["index"] not in protected]
+
+def delete_index_artifacts(index_name):
+    """Remove the near-duplicate records and failure records kept for an index"""
+    store = get_artifact_store()
+    keys = store.list(f"dedup/{index_name}/")
+    for key in keys:
+        store.delete(key)
+    failures = [record for record in list_failures() if record.get("index_name") == index_name]
+    for record in failures:
+        clear_failure(record["fileName"], index_name)
+    return len(keys), len(failures)
+
+def gc(args):
+    """Delete indexes that were switched away from, keeping the newest --keep for rollback"""
+    from azure.core.exceptions import ResourceNotFoundError
+
+    pointer = read_index_pointer(use_cache=False)
+    if not pointer:
+        print("No index pointer has been written; nothing to collect")
+        return 0
+
+    index_client = get_index_client()
+    for index_name in indexes_to_collect(pointer, args.keep):
+        try:
+            index_client.delete_index(index_name)
+            print(f"Deleted index {index_name}")
+        except ResourceNotFoundError:
+            print(f"Index {index_name} was already deleted")
+        dedup_keys, failures = delete_index_artifacts(index_name)
+        print(f"Deleted {dedup_keys} near-duplicate artifacts and {failures} failure records of {index_name}")
+
+    write_index_pointer(pointer["index"], pointer["deployment"], keep_previous=args.keep)
+    return 0
+
+def status(args):
+    pointer = read_index_pointer(use_cache=False)
+    print(f"Live index:  {resolve_index_name()}")
+    print(f"Deployment:  {resolve_embedding_deployment()}")
+    if pointer:
+        print(f"Switched at: {pointer.get('switched_dt')}")
+        if pointer.get("building"):
+            print(f"Building:    {pointer['building']['index']} ({pointer['building']['deployment']})")
+        for entry in pointer.get("previous", []):
+            print(f"Previous:    {entry['index']} ({entry['deployment']})")
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build, compare and switch to a shadow search index")
+    parser.add_argument("--settings", default="local.settings.json",
+                        help="Settings file to load into the environment if present")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    status_parser = subparsers.add_parser("status", help="Show the live index and rollback history")
+    status_parser.set_defaults(func=status)
+
+    build_parser = subparsers.add_parser("build", help="Create and backfill a shadow index")
+    build_parser.add_argument("--shadow", required=True, help="Shadow index name")
+    build_parser.add_argument("--deployment", required=True, help="Embedding deployment for the shadow index")
+    build_parser.add_argument("--dimensions", type=int, help="Vector dimensions of the new deployment")
+    build_parser.add_argument("--container", default=backfill.DEFAULT_CONTAINER)
+    build_parser.add_argument("--source-dir")
+    build_parser.add_argument("--workers", type=int, default=(os.cpu_count() or 1) * 4)
+    build_parser.add_argument("--executor", choices=["thread", "process"], default="thread")
+    build_parser.add_argument("--checkpoint", help="Defaults to build-<shadow>.checkpoint")
+    build_parser.set_defaults(func=build)
+
+    for name, func, help_text in [("compare", compare, "Compare recall and latency of live and shadow"),
+                                  ("switch", switch, "Point readers and writers at the shadow index")]:
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--shadow", required=True, help="Shadow index name")
+        sub.add_argument("--deployment", required=True, help="Embedding deployment used by the shadow index")
+        sub.add_argument("--queries", required=(name == "compare"), help="File with one query per line")
+        sub.add_argument("-k", type=int, default=10, help="Results compared per query (default: %(default)s)")
+        if name == "switch":
+            sub.add_argument("--min-recall", type=float,
+                             help="Refuse to switch below this recall@k (requires --queries)")
+            switch_parser = sub
+        sub.set_defaults(func=func)
+
+    cancel_parser = subparsers.add_parser("cancel", help="Stop writing new documents to the shadow index")
+    cancel_parser.set_defaults(func=cancel)
+
+    gc_parser = subparsers.add_parser("gc", help="Delete indexes that were switched away from")
+    gc_parser.add_argument("--keep", type=int, default=1,
+                           help="Previous indexes to keep for rollback (default: %(default)s)")
+    gc_parser.set_defaults(func=gc)
+
+    args = parser.parse_args(argv)
+    if args.command == "switch" and args.min_recall is not None and not args.queries:
+        switch_parser.error("--min-recall requires --queries")
+    logging.basicConfig(level=logging.WARNING)
+    backfill.load_local_settings(args.settings)
+    if args.command == "build":
+        os.environ.setdefault("CONCURRENCY_MAX_DOCUMENTS", str(args.workers))
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
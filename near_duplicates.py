@@ -0,0 +1,305 @@
+"""Near-duplicate chunk detection with MinHash-LSH.
+
+Each chunk gets a MinHash signature over word shingles. Signatures are
+banded into an LSH table so candidate matches are found without comparing
+against every chunk, then confirmed by estimated Jaccard similarity.
+
+The index is persisted in the artifact store under
+dedup/<index>/<deployment>/ and shared across invocations and instances:
+
+    records/<chunk id>.json       signature and vector key of one canonical chunk
+    snapshot.json                 records folded together, read in one GET
+    vectors/<content hash>.json   embedding, read only when a chunk matches
+
+Vectors are keyed by chunk content, so a record that is stale because its
+chunk was since rewritten still points at a vector that matches its
+signature. Per-chunk records are newer than the snapshot and override it.
+The first caller after a load folds them into the snapshot once
+DEDUP_COMPACT_RECORDS of them have piled up; "compact" does the same on demand:
+
+    python near_duplicates.py compact --index docs --deployment text-embedding-ada-002
+
+Each process re-lists the records every DEDUP_REFRESH_SECONDS to pick up
+chunks other instances added, and re-reads the snapshot only when its
+version (etag) changed. Until then, and when two instances compact at
+once, a duplicate can be missed; that only costs an extra embedding.
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+from artifact_store import get_artifact_store
+
+SHINGLE_WORDS = 5
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 16
+LSH_ROWS = NUM_PERMUTATIONS // LSH_BANDS
+
+# Mersenne prime used for the universal hash family
+_PRIME = (1 << 61) - 1
+
+DEDUP_COMPACT_RECORDS = int(os.environ.get("DEDUP_COMPACT_RECORDS", "500"))
+DEDUP_REFRESH_SECONDS = float(os.environ.get("DEDUP_REFRESH_SECONDS", "300"))
+
+_random = random.Random(1)  # Fixed seed: signatures must be comparable across processes
+_PERMUTATIONS = [(_random.randrange(1, _PRIME), _random.randrange(0, _PRIME)) for _ in range(NUM_PERMUTATIONS)]
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+def shingles(text):
+    """Hashed word shingles of the normalized text"""
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < SHINGLE_WORDS:
+        windows = [words] if words else []
+    else:
+        windows = [words[i:i + SHINGLE_WORDS] for i in range(len(words) - SHINGLE_WORDS + 1)]
+    return {
+        int.from_bytes(hashlib.blake2b(" ".join(window).encode("utf-8"), digest_size=8).digest(), "big")
+        for window in windows
+    }
+
+def minhash_signature(text):
+    """MinHash signature of the text's shingles, or None for empty text"""
+    hashed = shingles(text)
+    if not hashed:
+        return None
+    return [min((a * h + b) % _PRIME for h in hashed) for a, b in _PERMUTATIONS]
+
+def estimate_similarity(signature, other):
+    """Estimated Jaccard similarity of two signatures"""
+    return sum(1 for x, y in zip(signature, other) if x == y) / len(signature)
+
+def _band_keys(signature):
+    return [(band, tuple(signature[band * LSH_ROWS:(band + 1) * LSH_ROWS])) for band in range(LSH_BANDS)]
+
+def content_key(text):
+    """Key of a chunk's vector, derived from the chunk text"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+class LshTable:
+    """In-memory LSH table of signatures, keyed by anything hashable"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.signatures = {}
+        self._buckets = {}
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def insert(self, key, signature):
+        """Add a signature, replacing whatever key had before"""
+        self.remove(key)
+        self.signatures[key] = signature
+        for band_key in _band_keys(signature):
+            self._buckets.setdefault(band_key, set()).add(key)
+
+    def remove(self, key):
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return
+        for band_key in _band_keys(signature):
+            bucket = self._buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band_key]
+
+    def find(self, signature):
+        """Return (key, similarity) of the closest match above the threshold"""
+        best_key, best_similarity = None, 0.0
+        candidates = {key for band_key in _band_keys(signature) for key in self._buckets.get(band_key, ())}
+        for key in candidates:
+            similarity = estimate_similarity(signature, self.signatures[key])
+            if similarity >= self.threshold and similarity > best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key, best_similarity
+
+class NearDuplicateIndex:
+    """LSH table of canonical chunk signatures for one index and deployment"""
+
+    def __init__(self, store, namespace, threshold):
+        self.store = store
+        self.prefix = f"dedup/{namespace}"
+        self.threshold = threshold
+        self._table = LshTable(threshold)
+        self._records = {}
+        self._seen_keys = set()
+        self._unfolded_keys = []
+        self._snapshot_version = None
+        self._refreshed = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._load()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._records)
+
+    def _record_key(self, chunk_id):
+        return f"{self.prefix}/records/{chunk_id}.json"
+
+    def _read_records(self, keys):
+        records = {}
+        for key in keys:
+            data = self.store.get(key)
+            if data:
+                records[key.rsplit("/", 1)[-1][:-len(".json")]] = json.loads(data)
+        return records
+
+    def _read_snapshot(self):
+        # Version first, so a rewrite racing this read is picked up by the next refresh
+        self._snapshot_version = self.store.version(f"{self.prefix}/snapshot.json")
+        data = self.store.get(f"{self.prefix}/snapshot.json")
+        return json.loads(data) if data else {}
+
+    def _insert(self, chunk_id, record):
+        # Called with self._lock held
+        self._records[chunk_id] = record
+        self._table.insert(chunk_id, record["signature"])
+
+    def _load(self):
+        records = self._read_snapshot()
+        keys = self.store.list(f"{self.prefix}/records/")
+        records.update(self._read_records(keys))
+        with self._lock:
+            for chunk_id, record in records.items():
+                self._insert(chunk_id, record)
+            self._seen_keys.update(keys)
+            self._refreshed = time.monotonic()
+        # Folded by compact_if_due(), outside the lock that guards creating the index
+        self._unfolded_keys = keys if len(keys) >= DEDUP_COMPACT_RECORDS else []
+        logging.info(f"Loaded {len(records)} chunk signatures from {self.prefix} ({len(keys)} unfolded)")
+
+    def _fold(self, keys):
+        """Write the in-memory records as the snapshot and delete the per-chunk records in keys"""
+        with self._lock:
+            snapshot = dict(self._records)
+        self.store.put(f"{self.prefix}/snapshot.json", json.dumps(snapshot).encode("utf-8"))
+        self._snapshot_version = self.store.version(f"{self.prefix}/snapshot.json")
+        # Only records already loaded; ones written since stay for the next compaction
+        for key in keys:
+            self.store.delete(key)
+        with self._lock:
+            self._seen_keys.difference_update(keys)
+        logging.info(f"Folded {len(keys)} chunk records into the {self.prefix} snapshot")
+        return len(snapshot)
+
+    def compact_if_due(self):
+        """Fold the records loaded at start-up once DEDUP_COMPACT_RECORDS of them piled up"""
+        if not self._unfolded_keys or not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            keys, self._unfolded_keys = self._unfolded_keys, []
+            self._fold(keys)
+        finally:
+            self._refresh_lock.release()
+
+    def compact(self):
+        """Re-read the store and fold every per-chunk record into the snapshot"""
+        self.refresh()
+        return self._fold(self.store.list(f"{self.prefix}/records/"))
+
+    def refresh(self):
+        """Pick up records other instances wrote since this one loaded"""
+        keys = set(self.store.list(f"{self.prefix}/records/"))
+        with self._lock:
+            new_keys = keys - self._seen_keys
+            folded = {key.rsplit("/", 1)[-1][:-len(".json")] for key in self._seen_keys - keys}
+        # The snapshot is large; read it only when another instance rewrote it
+        snapshot = {}
+        if self.store.version(f"{self.prefix}/snapshot.json") != self._snapshot_version:
+            snapshot = self._read_snapshot()
+        records = self._read_records(sorted(new_keys))
+        with self._lock:
+            for chunk_id, record in snapshot.items():
+                # Records that disappeared were folded into this snapshot
+                if chunk_id in folded or chunk_id not in self._records:
+                    self._insert(chunk_id, record)
+            for chunk_id, record in records.items():
+                self._insert(chunk_id, record)
+            self._seen_keys = keys
+            self._refreshed = time.monotonic()
+
+    def refresh_if_stale(self):
+        """Refresh at most every DEDUP_REFRESH_SECONDS, skipping if another thread already is"""
+        if time.monotonic() - self._refreshed < DEDUP_REFRESH_SECONDS:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        try:
+            self.refresh()
+        finally:
+            self._refresh_lock.release()
+
+    def find(self, signature):
+        """Return (canonical chunk id, similarity) of the closest match above the threshold"""
+        with self._lock:
+            return self._table.find(signature)
+
+    def add(self, chunk_id, text, signature, vector):
+        """Record a newly embedded chunk as canonical, replacing any earlier record for chunk_id"""
+        record = {"signature": signature, "vector": content_key(text)}
+        self.store.put(f"{self.prefix}/vectors/{record['vector']}.json", json.dumps(vector).encode("utf-8"))
+        self.store.put(self._record_key(chunk_id), json.dumps(record).encode("utf-8"))
+        with self._lock:
+            self._insert(chunk_id, record)
+            self._seen_keys.add(self._record_key(chunk_id))
+
+    def get_vector(self, chunk_id):
+        """Stored vector of a canonical chunk, or None if it was never written"""
+        with self._lock:
+            record = self._records.get(chunk_id)
+        if record is None:
+            return None
+        data = self.store.get(f"{self.prefix}/vectors/{record['vector']}.json")
+        return json.loads(data) if data else None
+
+def get_near_duplicate_index(index_name, deployment_name):
+    """Shared index for this process, or None when DEDUP_THRESHOLD or the artifact store is unset"""
+    threshold = float(os.environ.get("DEDUP_THRESHOLD", "0") or 0)
+    store = get_artifact_store()
+    if not threshold or store is None:
+        return None
+
+    namespace = f"{index_name}/{deployment_name}"
+    with _indexes_lock:
+        if namespace not in _indexes:
+            _indexes[namespace] = NearDuplicateIndex(store, namespace, threshold)
+        index = _indexes[namespace]
+    # Store round trips happen outside _indexes_lock so other threads keep embedding
+    index.compact_if_due()
+    index.refresh_if_stale()
+    return index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the near-duplicate chunk index")
+    parser.add_argument("command", choices=["compact"])
+    parser.add_argument("--index", required=True, help="Search index the chunks were written to")
+    parser.add_argument("--deployment", required=True, help="Embedding deployment of the stored vectors")
+    parser.add_argument("--settings", default="local.settings.json",
+                        help="Settings file to load into the environment if present")
+    args = parser.parse_args(argv)
+
+    import backfill
+    backfill.load_local_settings(args.settings)
+    store = get_artifact_store()
+    if store is None:
+        print("No artifact store configured (ARTIFACT_STORE_CONTAINER or ARTIFACT_STORE_DIR)", file=sys.stderr)
+        return 1
+
+    index = NearDuplicateIndex(store, f"{args.index}/{args.deployment}", threshold=1.0)
+    print(f"Compacted {index.compact()} chunk signatures")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+"""List and replay documents recorded in the failure store.
+
+Replay resumes each document from the stage that failed, using the
+artifacts saved with its failure record. An index failure re-uploads the
+saved embeddings and an embed failure re-embeds the saved chunks. Only read
+or analyze failures (and workbooks, which are parsed locally) read the
+original document again.
+
+    python replay.py list [--stage embed] [--error-class RateLimitError]
+    python replay.py replay [--stage index] [--workers 8] [--source-dir ./docs]
+"""
+
+import argparse
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import backfill
+from concurrency import get_limiter
+from failure_store import (STAGES, DocumentProcessingError, clear_failure, list_failures, load_artifacts,
+                           record_failure)
+
+def replay_failure(record, source_dir=None):
+    """Resume one failed document; returns the number of chunks indexed"""
+    from ProcessUploadedDocument import resume_document, resume_needs_source
+
+    doc_name = record["fileName"]
+    artifacts = load_artifacts(record)
+    artifacts.setdefault("index_name", record.get("index_name"))
+    artifacts.setdefault("deployment_name", record.get("deployment_name"))
+
+    try:
+        document_bytes = None
+        if resume_needs_source(doc_name, record["stage"]):
+            document_bytes = backfill.read_document(doc_name, source_dir)
+        with get_limiter("documents").acquire():
+            chunks = resume_document(doc_name, record["stage"], artifacts, document_bytes)
+    except DocumentProcessingError as e:
+        record_failure(e)
+        raise
+    clear_failure(doc_name, record.get("index_name"))
+    return chunks
+
+def list_command(args):
+    records = list_failures(args.stage, args.error_class)
+    for record in records:
+        print(f"{record['failed_dt']}  {record['stage']:<8} {record['error_class']:<28} "
+              f"attempts={record['attempts']}  {record['fileName']}")
+    print(f"{len(records)} failed documents", file=sys.stderr)
+    return 0
+
+def replay_command(args):
+    records = list_failures(args.stage, args.error_class)
+    if not records:
+        print("No failed documents match", file=sys.stderr)
+        return 0
+
+    progress = backfill.Progress(len(records))
+    failed = []
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(replay_failure, record, args.source_dir): record for record in records}
+        for future in as_completed(futures):
+            record = futures[future]
+            try:
+                chunks = future.result()
+            except Exception as e:
+                logging.error(f"Replay failed for {record['fileName']}: {str(e)}")
+                failed.append(record["fileName"])
+                progress.update(failed=True)
+                continue
+            progress.update(chunks=chunks)
+
+    if failed:
+        print(f"{len(failed)} documents failed again and stay in the failure store", file=sys.stderr)
+        return 1
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List and replay failed documents")
+    parser.add_argument("--settings", default="local.settings.json",
+                        help="Settings file to load into the environment if present")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for name, func, help_text in [("list", list_command, "Show failed documents"),
+                                  ("replay", replay_command, "Resume failed documents from the failed stage")]:
+        sub = subparsers.add_parser(name, help=help_text)
+        sub.add_argument("--stage", choices=STAGES, help="Only documents that failed at this stage")
+        sub.add_argument("--error-class", help="Only documents that failed with this exception class")
+        if name == "replay":
+            sub.add_argument("--workers", type=int, default=(os.cpu_count() or 1) * 4,
+                             help="Parallel documents in flight (default: %(default)s)")
+            sub.add_argument("--source-dir",
+                             help="Read documents from a local directory instead of blob storage")
+        sub.set_defaults(func=func)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    backfill.load_local_settings(args.settings)
+    if args.command == "replay":
+        os.environ.setdefault("CONCURRENCY_MAX_DOCUMENTS", str(args.workers))
+    return args.func(args)
+
+if __name__ == "__main__":
+    sys.exit(main())
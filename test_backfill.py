@@ -0,0 +1,89 @@
+import os
+
+import backfill
+from backfill import Checkpoint
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+def test_list_documents_reports_local_versions(tmp_path):
+    write(str(tmp_path / "sub" / "a.pdf"), b"%PDF")
+    os.utime(tmp_path / "sub" / "a.pdf", ns=(1, 5_000_000_000))
+    assert backfill.list_documents(str(tmp_path)) == [("knowledge-docs/sub/a.pdf", 4, "5000000000")]
+
+def test_checkpoint_skips_only_unchanged_versions(tmp_path):
+    path = str(tmp_path / "backfill.checkpoint")
+    checkpoint = Checkpoint(path)
+    checkpoint.mark_done("knowledge-docs/a.pdf", "etag-1")
+
+    reloaded = Checkpoint(path)
+    assert reloaded.is_done("knowledge-docs/a.pdf", "etag-1")
+    assert not reloaded.is_done("knowledge-docs/a.pdf", "etag-2")
+    assert not reloaded.is_done("knowledge-docs/b.pdf", "etag-1")
+
+    reloaded.mark_done("knowledge-docs/a.pdf", "etag-2")
+    assert Checkpoint(path).is_done("knowledge-docs/a.pdf", "etag-2")
+
+def test_run_backfill_reprocesses_rewritten_documents(tmp_path, monkeypatch):
+    processed = []
+    monkeypatch.setattr(backfill, "backfill_document",
+                        lambda name, source_dir, index_name, deployment_name: processed.append(name) or 1)
+    checkpoint = Checkpoint(str(tmp_path / "backfill.checkpoint"))
+    checkpoint.mark_done("knowledge-docs/a.pdf", "1")
+    checkpoint.mark_done("knowledge-docs/b.pdf", "1")
+
+    documents = [("knowledge-docs/a.pdf", 10, "1"), ("knowledge-docs/b.pdf", 10, "2"), ("knowledge-docs/c.pdf", 10, "1")]
+    assert backfill.run_backfill(documents, workers=2, checkpoint=checkpoint) == []
+    assert sorted(processed) == ["knowledge-docs/b.pdf", "knowledge-docs/c.pdf"]
+    assert checkpoint.is_done("knowledge-docs/b.pdf", "2")
+
+def make_zip(files):
+    import io
+    import zipfile
+
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return data.getvalue()
+
+def test_estimate_pages_pdf_page_tree():
+    pdf = (b"%PDF-1.4\n1 0 obj << /Type /Pages /Kids [3 0 R 4 0 R 5 0 R] /Count 3 >> endobj\n"
+           b"3 0 obj << /Type /Page /Parent 1 0 R >> endobj\n")
+    assert backfill.estimate_pages("a.pdf", pdf) == 3
+    assert backfill.estimate_pages("a.pdf", b"%PDF-1.4\n<< /Type /Page >> << /Type /Page >>") == 2
+
+def test_estimate_pages_pdf_object_streams():
+    import zlib
+
+    objects = zlib.compress(b"1 0 2 40 << /Type /Pages /Kids [2 0 R 3 0 R] /Count 2 >> << /Type /Page >>")
+    pdf = (b"%PDF-1.5\n7 0 obj\n<< /Type /ObjStm /N 2 /First 8 /Filter /FlateDecode /Length "
+           + str(len(objects)).encode() + b" >>\nstream\n" + objects + b"\nendstream\nendobj\n")
+    assert backfill.estimate_pages("a.pdf", pdf) == 2
+
+def test_estimate_pages_office_properties():
+    docx = make_zip({"docProps/app.xml": "<Properties><Pages>12</Pages><Words>900</Words></Properties>"})
+    pptx = make_zip({"docProps/app.xml": "<Properties><Slides>30</Slides></Properties>"})
+    assert backfill.estimate_pages("a.docx", docx) == 12
+    assert backfill.estimate_pages("a.pptx", pptx) == 30
+    assert backfill.estimate_pages("a.docx", make_zip({"word/document.xml": ""})) == 1
+    assert backfill.estimate_pages("a.docx", b"not a zip") == 1
+    assert backfill.estimate_pages("a.doc", b"") == 1
+
+def test_dry_run_counts_pages_and_spreadsheet_tokens(tmp_path, capsys):
+    import openpyxl
+
+    write(str(tmp_path / "a.pptx"), make_zip({"docProps/app.xml": "<Properties><Slides>4</Slides></Properties>"}))
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["id", "body"])
+    workbook.active.append([1, "x" * 400])
+    workbook.save(str(tmp_path / "b.xlsx"))
+    write(str(tmp_path / "c.txt"), b"ignored")
+
+    backfill.dry_run(backfill.list_documents(str(tmp_path)), str(tmp_path), tokens_per_page=100)
+    output = capsys.readouterr().out
+    assert "Supported documents:   2" in output
+    assert "Estimated pages:       4" in output
+    assert "Estimated tokens:      5" in output
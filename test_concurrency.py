@@ -0,0 +1,69 @@
+import threading
+
+import pytest
+
+from concurrency import AdaptiveLimit, get_limiter
+
+class Throttled(Exception):
+    status_code = 429
+
+def run(limit, error):
+    with pytest.raises(type(error)):
+        with limit.acquire():
+            raise error
+
+def test_failures_other_than_throttling_leave_the_limit_alone():
+    limit = AdaptiveLimit("embed", 8)
+    run(limit, ValueError("bad input"))
+    metrics = limit.metrics()
+    assert (metrics["limit"], metrics["completed"], metrics["failed"]) == (8, 0, 1)
+    assert metrics["no_load_rtt_ms"] is None and metrics["in_flight"] == 0
+
+def test_throttling_halves_the_limit():
+    limit = AdaptiveLimit("index", 8, latency_sensitive=False)
+    run(limit, Throttled())
+    assert limit.metrics()["limit"] == 4
+    assert limit.metrics()["throttled"] == 1
+
+def test_acquire_times_out_when_no_slot_frees_up():
+    limit = AdaptiveLimit("documents", 1, latency_sensitive=False)
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with limit.acquire():
+            held.set()
+            release.wait()
+
+    worker = threading.Thread(target=hold)
+    worker.start()
+    held.wait()
+    with pytest.raises(TimeoutError):
+        with limit.acquire(timeout=0.05):
+            pass
+    release.set()
+    worker.join()
+    assert limit.metrics()["in_flight"] == 0
+
+def test_only_embed_follows_latency():
+    assert get_limiter("embed").latency_sensitive
+    assert not any(get_limiter(name).latency_sensitive for name in ("documents", "analyze", "index"))
+
+def test_retried_throttles_halve_the_limit_without_failing_the_call():
+    limit = AdaptiveLimit("embed", 8)
+    with limit.acquire():
+        limit.record_throttle()
+        limit.record_throttle()
+    metrics = limit.metrics()
+    # No latency observed yet, so no window groups the two
+    assert (metrics["limit"], metrics["throttled"], metrics["failed"]) == (2, 2, 0)
+
+def test_embed_latency_is_compared_per_input():
+    limit = AdaptiveLimit("embed", 4)
+    limit.in_flight = 3
+    limit._update(0.1, False, cost=1)
+    grown = limit.limit
+    # Sixteen inputs in 1.6s is the same per-input latency, so no queue is inferred
+    limit._update(1.6, False, cost=16)
+    assert limit.no_load_rtt == pytest.approx(0.1)
+    assert limit.limit > grown
@@ -0,0 +1,51 @@
+import pytest
+
+import index_pointer
+from artifact_store import LocalArtifactStore
+from index_pointer import read_index_pointer, resolve_write_targets, write_building_index, write_index_pointer
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    store = LocalArtifactStore(str(tmp_path))
+    monkeypatch.setattr(index_pointer, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(index_pointer, "_cached_pointer", None)
+    monkeypatch.setenv("SEARCH_INDEX_NAME", "docs")
+    monkeypatch.setenv("OPENAI_EMBEDDING_DEPLOYMENT_NAME", "ada")
+    return store
+
+def test_settings_are_used_without_a_pointer():
+    assert read_index_pointer() is None
+    assert index_pointer.resolve_index_target() == ("docs", "ada")
+    assert resolve_write_targets() == [("docs", "ada")]
+
+def test_switch_history_and_trimming():
+    write_index_pointer("docs-v2", "large")
+    write_index_pointer("docs-v3", "large")
+    pointer = write_index_pointer("docs", "ada")
+    assert pointer["index"] == "docs"
+    # The index switched to leaves the history; the newest retired index comes first
+    assert [entry["index"] for entry in pointer["previous"]] == ["docs-v3", "docs-v2"]
+
+    pointer = write_index_pointer("docs", "ada", keep_previous=1)
+    assert [entry["index"] for entry in pointer["previous"]] == ["docs-v3"]
+
+def test_rewriting_the_same_target_keeps_switch_time():
+    switched = write_index_pointer("docs-v2", "large")["switched_dt"]
+    assert write_index_pointer("docs-v2", "large", keep_previous=0)["switched_dt"] == switched
+
+def test_building_index_is_a_write_target_until_switched_to():
+    write_building_index("docs-v2", "large")
+    assert resolve_write_targets() == [("docs", "ada"), ("docs-v2", "large")]
+
+    # Trimming history keeps the build registered
+    write_index_pointer("docs", "ada", keep_previous=0)
+    assert resolve_write_targets() == [("docs", "ada"), ("docs-v2", "large")]
+
+    write_index_pointer("docs-v2", "large")
+    assert "building" not in read_index_pointer()
+    assert resolve_write_targets() == [("docs-v2", "large")]
+
+def test_cancelled_build_is_no_longer_written():
+    write_building_index("docs-v2", "large")
+    write_building_index(None, None)
+    assert resolve_write_targets() == [("docs", "ada")]
@@ -0,0 +1,123 @@
+import json
+
+import pytest
+
+import backfill
+import failure_store
+import index_pointer
+import index_swap
+from artifact_store import LocalArtifactStore
+from failure_store import DocumentProcessingError, list_failures, record_failure
+from index_pointer import read_index_pointer, write_building_index, write_index_pointer
+
+class FakeIndexClient:
+    def __init__(self, existing):
+        self.existing = set(existing)
+        self.deleted = []
+
+    def get_index(self, name):
+        from azure.core.exceptions import ResourceNotFoundError
+
+        if name not in self.existing:
+            raise ResourceNotFoundError(f"{name} not found")
+        return name
+
+    def delete_index(self, name):
+        self.deleted.append(name)
+        self.existing.discard(name)
+
+@pytest.fixture(autouse=True)
+def store(tmp_path, monkeypatch):
+    store = LocalArtifactStore(str(tmp_path))
+    for module in (index_pointer, index_swap, failure_store):
+        monkeypatch.setattr(module, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(index_pointer, "_cached_pointer", None)
+    monkeypatch.setenv("SEARCH_INDEX_NAME", "docs")
+    monkeypatch.setenv("OPENAI_EMBEDDING_DEPLOYMENT_NAME", "ada")
+    return store
+
+@pytest.fixture
+def index_client(monkeypatch):
+    client = FakeIndexClient({"docs", "docs-v2"})
+    monkeypatch.setattr(index_swap, "get_index_client", lambda: client)
+    return client
+
+def run(*argv):
+    return index_swap.main(["--settings", "none", *argv])
+
+def test_switch_refuses_a_missing_index(index_client):
+    assert run("switch", "--shadow", "docs-v9", "--deployment", "large") == 1
+    assert read_index_pointer(use_cache=False) is None
+
+def test_switch_rejects_min_recall_without_queries(index_client):
+    with pytest.raises(SystemExit):
+        run("switch", "--shadow", "docs-v2", "--deployment", "large", "--min-recall", "0.7")
+
+def test_switch_refuses_an_empty_queries_file(index_client, tmp_path):
+    queries = tmp_path / "queries.txt"
+    queries.write_text("\n  \n")
+    assert run("switch", "--shadow", "docs-v2", "--deployment", "large", "--queries", str(queries)) == 1
+    assert read_index_pointer(use_cache=False) is None
+
+def test_switch_mirrors_before_flipping(index_client, monkeypatch):
+    waits = []
+    monkeypatch.setattr(index_swap.time, "sleep",
+                        lambda seconds: waits.append(read_index_pointer(use_cache=False)["building"]))
+    assert run("switch", "--shadow", "docs-v2", "--deployment", "large") == 0
+    assert waits == [{"index": "docs-v2", "deployment": "large"}]
+    pointer = read_index_pointer(use_cache=False)
+    assert (pointer["index"], pointer.get("building")) == ("docs-v2", None)
+
+def test_switch_after_build_does_not_wait(index_client, monkeypatch):
+    monkeypatch.setattr(index_swap.time, "sleep", lambda seconds: pytest.fail("should not wait"))
+    write_building_index("docs-v2", "large")
+    assert run("switch", "--shadow", "docs-v2", "--deployment", "large") == 0
+
+def test_indexes_to_collect_skips_kept_live_and_building():
+    pointer = {"index": "docs-v4", "building": {"index": "docs-v1", "deployment": "large"},
+               "previous": [{"index": name, "deployment": "ada"} for name in ("docs-v3", "docs-v2", "docs-v1")]}
+    assert index_swap.indexes_to_collect(pointer, keep=1) == ["docs-v2"]
+    assert index_swap.indexes_to_collect(pointer, keep=0) == ["docs-v3", "docs-v2"]
+
+def test_gc_removes_retired_index_artifacts(index_client, store):
+    write_index_pointer("docs-v2", "large")
+    store.put("dedup/docs/ada/records/a.json", b"{}")
+    store.put("dedup/docs-v2/large/records/a.json", b"{}")
+    record_failure(DocumentProcessingError("knowledge-docs/a.pdf", "embed", TimeoutError(), {"index_name": "docs"}))
+    record_failure(DocumentProcessingError("knowledge-docs/a.pdf", "embed", TimeoutError(), {"index_name": "docs-v2"}))
+
+    assert run("gc", "--keep", "0") == 0
+    assert index_client.deleted == ["docs"]
+    assert store.list("dedup/") == ["dedup/docs-v2/large/records/a.json"]
+    assert [record["index_name"] for record in list_failures()] == ["docs-v2"]
+    assert json.loads(store.get("index-pointer.json"))["previous"] == []
+
+def test_backfill_rejects_deployment_for_the_live_index(monkeypatch):
+    for argv in (["--deployment", "large"], ["--deployment", "large", "--index", "docs"]):
+        with pytest.raises(SystemExit):
+            backfill.main(["--settings", "none", "--dry-run", *argv])
+
+def test_build_registers_shadow_and_removes_deleted_documents(index_client, tmp_path, monkeypatch):
+    import ProcessUploadedDocument as pipeline
+
+    source = tmp_path / "source"
+    source.mkdir()
+    (source / "a.pdf").write_bytes(b"%PDF")
+    checkpoint_path = str(tmp_path / "build.checkpoint")
+    checkpoint = backfill.Checkpoint(checkpoint_path)
+    checkpoint.mark_done("knowledge-docs/gone.pdf", "1")
+
+    deleted = []
+    backfilled = []
+    monkeypatch.setattr(index_swap, "create_shadow_index", lambda name, dimensions=None: None)
+    monkeypatch.setattr(pipeline, "delete_stale_chunks",
+                        lambda doc_name, chunk_indexes, index_name=None: deleted.append((doc_name, index_name)))
+    monkeypatch.setattr(backfill, "run_backfill",
+                        lambda documents, *args, **kwargs: backfilled.extend(name for name, _, _ in documents) or [])
+
+    assert run("build", "--shadow", "docs-v2", "--deployment", "large", "--source-dir", str(source),
+               "--checkpoint", checkpoint_path) == 0
+    assert read_index_pointer(use_cache=False)["building"] == {"index": "docs-v2", "deployment": "large"}
+    assert deleted == [("knowledge-docs/gone.pdf", "docs-v2")]
+    assert backfilled == ["knowledge-docs/a.pdf"]
+    assert backfill.Checkpoint(checkpoint_path).completed == {}
@@ -0,0 +1,160 @@
+import json
+
+import pytest
+
+import near_duplicates
+from artifact_store import LocalArtifactStore
+from near_duplicates import (NUM_PERMUTATIONS, LshTable, NearDuplicateIndex, estimate_similarity, minhash_signature,
+                             shingles)
+
+TEXT = "the quarterly report covers revenue growth across all regions and product lines in detail"
+NEAR_TEXT = TEXT + " this year"
+OTHER_TEXT = "install the package and run the migration script before starting the web server again"
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalArtifactStore(str(tmp_path))
+
+def test_shingles_normalize_case_and_punctuation():
+    assert shingles("One, two; THREE four five") == shingles("one two three four five")
+    assert len(shingles("one two three four five six")) == 2
+
+def test_shingles_short_and_empty_text():
+    assert len(shingles("just three words")) == 1
+    assert shingles("  ...  ") == set()
+
+def test_minhash_signature():
+    signature = minhash_signature(TEXT)
+    assert len(signature) == NUM_PERMUTATIONS
+    assert signature == minhash_signature(TEXT.upper())
+    assert minhash_signature("") is None
+    assert estimate_similarity(signature, minhash_signature(NEAR_TEXT)) > 0.6
+    assert estimate_similarity(signature, minhash_signature(OTHER_TEXT)) < 0.2
+
+def test_lsh_table_insert_replaces_signature():
+    table = LshTable(0.8)
+    table.insert("a", minhash_signature(TEXT))
+    assert table.find(minhash_signature(TEXT))[0] == "a"
+
+    table.insert("a", minhash_signature(OTHER_TEXT))
+    assert len(table) == 1
+    assert table.find(minhash_signature(TEXT)) == (None, 0.0)
+    assert table.find(minhash_signature(OTHER_TEXT))[0] == "a"
+
+    table.remove("a")
+    assert table.find(minhash_signature(OTHER_TEXT)) == (None, 0.0)
+
+def test_find_and_add(store):
+    index = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    assert index.find(minhash_signature(TEXT)) == (None, 0.0)
+
+    index.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1, 0.2])
+    chunk_id, similarity = index.find(minhash_signature(NEAR_TEXT))
+    assert chunk_id == "chunk-1" and similarity >= 0.6
+    assert index.get_vector("chunk-1") == [0.1, 0.2]
+    assert index.find(minhash_signature(OTHER_TEXT)) == (None, 0.0)
+    assert index.get_vector("missing") is None
+
+def test_re_add_replaces_record(store):
+    index = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    index.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    index.add("chunk-1", OTHER_TEXT, minhash_signature(OTHER_TEXT), [0.9])
+
+    assert index.find(minhash_signature(TEXT)) == (None, 0.0)
+    assert index.find(minhash_signature(OTHER_TEXT))[0] == "chunk-1"
+    assert index.get_vector("chunk-1") == [0.9]
+
+    reloaded = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    assert reloaded.find(minhash_signature(TEXT)) == (None, 0.0)
+    assert reloaded.get_vector("chunk-1") == [0.9]
+
+def test_records_override_snapshot(store):
+    index = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    index.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    assert index.compact() == 1
+    assert store.list("dedup/docs/ada/records/") == []
+
+    index.add("chunk-1", OTHER_TEXT, minhash_signature(OTHER_TEXT), [0.9])
+    reloaded = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    assert reloaded.find(minhash_signature(TEXT)) == (None, 0.0)
+    assert reloaded.get_vector("chunk-1") == [0.9]
+
+def test_load_compacts_once_records_pile_up(store, monkeypatch):
+    monkeypatch.setattr(near_duplicates, "DEDUP_COMPACT_RECORDS", 2)
+    writer = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    writer.add("chunk-2", OTHER_TEXT, minhash_signature(OTHER_TEXT), [0.2])
+
+    reader = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    assert len(store.list("dedup/docs/ada/records/")) == 2
+    reader.compact_if_due()
+    assert store.list("dedup/docs/ada/records/") == []
+    assert set(json.loads(store.get("dedup/docs/ada/snapshot.json"))) == {"chunk-1", "chunk-2"}
+
+def test_refresh_picks_up_other_instances(store):
+    reader = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    assert reader.find(minhash_signature(TEXT)) == (None, 0.0)
+
+    reader.refresh()
+    assert reader.find(minhash_signature(TEXT))[0] == "chunk-1"
+
+    writer.add("chunk-2", OTHER_TEXT, minhash_signature(OTHER_TEXT), [0.2])
+    writer.compact()
+    reader.refresh()
+    assert reader.find(minhash_signature(OTHER_TEXT))[0] == "chunk-2"
+
+def test_refresh_reads_records_folded_before_it_saw_them(store):
+    reader = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    writer.compact()
+
+    reader.refresh()
+    assert reader.find(minhash_signature(TEXT))[0] == "chunk-1"
+
+class CountingStore(LocalArtifactStore):
+    def __init__(self, root):
+        super().__init__(root)
+        self.reads = []
+        self.lock_held_on_put = []
+
+    def get(self, key):
+        self.reads.append(key)
+        return super().get(key)
+
+    def put(self, key, data):
+        self.lock_held_on_put.append(near_duplicates._indexes_lock.locked())
+        super().put(key, data)
+
+def test_refresh_reads_the_snapshot_only_when_it_changed(tmp_path):
+    store = CountingStore(str(tmp_path))
+    writer = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+    writer.add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+    writer.compact()
+    reader = NearDuplicateIndex(store, "docs/ada", threshold=0.6)
+
+    store.reads.clear()
+    reader.refresh()
+    assert "dedup/docs/ada/snapshot.json" not in store.reads
+
+    writer.add("chunk-2", OTHER_TEXT, minhash_signature(OTHER_TEXT), [0.2])
+    writer.compact()
+    reader.refresh()
+    assert "dedup/docs/ada/snapshot.json" in store.reads
+    assert reader.find(minhash_signature(OTHER_TEXT))[0] == "chunk-2"
+
+def test_shared_index_compacts_outside_the_creation_lock(tmp_path, monkeypatch):
+    store = CountingStore(str(tmp_path))
+    monkeypatch.setattr(near_duplicates, "DEDUP_COMPACT_RECORDS", 1)
+    monkeypatch.setattr(near_duplicates, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(near_duplicates, "_indexes", {})
+    monkeypatch.setenv("DEDUP_THRESHOLD", "0.6")
+    NearDuplicateIndex(store, "docs/ada", threshold=0.6).add("chunk-1", TEXT, minhash_signature(TEXT), [0.1])
+
+    store.lock_held_on_put.clear()
+    index = near_duplicates.get_near_duplicate_index("docs", "ada")
+    assert store.list("dedup/docs/ada/records/") == []
+    assert store.lock_held_on_put == [False]
+    assert index.find(minhash_signature(TEXT))[0] == "chunk-1"
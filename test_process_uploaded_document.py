@@ -0,0 +1,303 @@
+import pytest
+
+import ProcessUploadedDocument as pipeline
+from artifact_store import LocalArtifactStore
+from near_duplicates import NearDuplicateIndex
+
+TEXT = "the quarterly report covers revenue growth across all regions and product lines in detail"
+OTHER_TEXT = "install the package and run the migration script before starting the web server again"
+
+@pytest.fixture
+def store(tmp_path):
+    return LocalArtifactStore(str(tmp_path))
+
+@pytest.fixture
+def embedded(monkeypatch):
+    """Texts sent to the embedding deployment; each gets a vector of its length"""
+    texts = []
+
+    def fake_embeddings(batch, deployment_name=None):
+        texts.extend(batch)
+        return [[float(len(text))] for text in batch]
+
+    monkeypatch.setattr(pipeline, "generate_embeddings_batch", fake_embeddings)
+    return texts
+
+def test_embed_chunks_matches_duplicates_within_the_batch(store, embedded, monkeypatch):
+    dedup_index = NearDuplicateIndex(store, "docs/ada", threshold=0.8)
+    monkeypatch.setattr(pipeline, "get_near_duplicate_index", lambda index_name, deployment_name: dedup_index)
+
+    chunks = [TEXT, OTHER_TEXT, TEXT.upper()]
+    chunk_indexes, embeddings, on_indexed = pipeline.embed_chunks("knowledge-docs/a.pdf", chunks, "docs", "ada")
+
+    assert embedded == [TEXT, OTHER_TEXT]
+    assert chunk_indexes == [0, 1, 2]
+    assert embeddings[2] == embeddings[0]
+
+    on_indexed()
+    assert len(dedup_index) == 2
+    embedded.clear()
+    pipeline.embed_chunks("knowledge-docs/b.pdf", [TEXT], "docs", "ada")
+    assert embedded == []
+
+def make_workbook(rows):
+    import io
+    import openpyxl
+
+    workbook = openpyxl.Workbook()
+    for row in rows:
+        workbook.active.append(row)
+    data = io.BytesIO()
+    workbook.save(data)
+    return data.getvalue()
+
+@pytest.mark.parametrize("failing_stage", ["embed", "index"])
+def test_resume_workbook_from_failed_batch(store, embedded, monkeypatch, failing_stage):
+    import failure_store
+
+    monkeypatch.setattr(failure_store, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(pipeline, "get_near_duplicate_index", lambda index_name, deployment_name: None)
+    monkeypatch.setattr(pipeline, "SPREADSHEET_BATCH_CHUNKS", 2)
+    deleted = []
+    monkeypatch.setattr(pipeline, "delete_stale_chunks",
+                        lambda doc_name, chunk_indexes, index_name=None: deleted.append(sorted(chunk_indexes)))
+
+    uploaded = {}
+    fail = {"batch": 1}
+
+    def fake_upload(doc_name, chunks, embeddings, index_name=None, chunk_indexes=None):
+        if failing_stage == "index" and fail["batch"] == 1 and chunk_indexes[0] == 2:
+            raise ConnectionError("connection reset")
+        uploaded.update(zip(chunk_indexes, chunks))
+
+    real_embed = pipeline.generate_embeddings_batch
+
+    def flaky_embed(texts, deployment_name=None):
+        if failing_stage == "embed" and fail["batch"] == 1 and len(uploaded) == 2:
+            raise TimeoutError("embeddings timed out")
+        return real_embed(texts, deployment_name)
+
+    monkeypatch.setattr(pipeline, "add_chunks_to_search_index", fake_upload)
+    monkeypatch.setattr(pipeline, "generate_embeddings_batch", flaky_embed)
+
+    doc_name = "knowledge-docs/book.xlsx"
+    document_bytes = make_workbook([("id", "body")] + [(i, f"row {i} " + "x" * 700) for i in range(10)])
+
+    with pytest.raises(failure_store.DocumentProcessingError) as failure:
+        pipeline.process_or_resume(doc_name, document_bytes, "docs", "ada")
+    assert failure.value.stage == failing_stage
+    assert failure_store.is_transient_error(failure.value)
+    assert failure_store.record_failure(failure.value)
+    record = failure_store.get_failure(doc_name, "docs")
+    assert record["index_name"] == "docs" and record["deployment_name"] == "ada"
+
+    fail["batch"] = None
+    embedded.clear()
+    assert pipeline.process_or_resume(doc_name, document_bytes, "docs", "ada") == 3
+    assert sorted(uploaded) == [0, 1, 2, 3, 4]
+    assert deleted == [[0, 1, 2, 3, 4]]
+    # Batches indexed before the failure are not embedded again; an index failure
+    # also reuses the failed batch's vectors
+    assert len(embedded) == (1 if failing_stage == "index" else 3)
+
+def test_document_processing_error_pickles_without_artifacts():
+    import pickle
+
+    class Unpicklable(Exception):
+        def __reduce__(self):
+            raise TypeError("no")
+
+    error = pipeline.DocumentProcessingError("a.pdf", "embed", TimeoutError("slow"), {"chunks": ["x"] * 1000})
+    restored = pickle.loads(pickle.dumps(error))
+    assert (restored.doc_name, restored.stage, restored.artifacts) == ("a.pdf", "embed", {})
+    assert isinstance(restored.cause, TimeoutError) and str(restored) == str(error)
+
+    error = pipeline.DocumentProcessingError("a.pdf", "index", Unpicklable("bad"))
+    assert "Unpicklable: bad" in str(pickle.loads(pickle.dumps(error)).cause)
+
+class FakeResult:
+    def __init__(self, key, status_code=200):
+        self.key = key
+        self.status_code = status_code
+        self.succeeded = status_code < 300
+        self.error_message = None if self.succeeded else "rejected"
+
+class FakeSearchClient:
+    def __init__(self, status_codes=None):
+        self.requests = []
+        self.status_codes = status_codes or {}
+
+    def upload_documents(self, documents):
+        self.requests.append(documents)
+        return [FakeResult(document["id"], self.status_codes.get(document["id"], 200)) for document in documents]
+
+def test_uploads_are_split_by_count_and_size(monkeypatch):
+    client = FakeSearchClient()
+    monkeypatch.setattr(pipeline, "get_search_client", lambda index_name=None: client)
+    monkeypatch.setattr(pipeline, "SEARCH_BATCH_DOCUMENTS", 4)
+    monkeypatch.setattr(pipeline, "SEARCH_BATCH_BYTES", 3000)
+
+    chunks = ["short"] * 6 + ["x" * 2000] * 2
+    pipeline.add_chunks_to_search_index("knowledge-docs/a.pdf", chunks, [[0.0]] * 8, "docs")
+    assert [len(request) for request in client.requests] == [4, 3, 1]
+
+@pytest.mark.parametrize("status_code, transient", [(503, True), (400, False)])
+def test_partially_rejected_upload_raises(monkeypatch, status_code, transient):
+    from failure_store import is_transient_error
+
+    rejected = pipeline.make_document_id("knowledge-docs/a.pdf", 1)
+    client = FakeSearchClient({rejected: status_code})
+    monkeypatch.setattr(pipeline, "get_search_client", lambda index_name=None: client)
+
+    with pytest.raises(pipeline.IndexingError) as error:
+        pipeline.add_chunks_to_search_index("knowledge-docs/a.pdf", ["a", "b"], [[0.0], [1.0]], "docs")
+    assert error.value.status_code == status_code
+    assert is_transient_error(error.value) == transient
+
+def test_shadow_copy_failures_are_recorded_not_raised(store, monkeypatch):
+    import failure_store
+
+    monkeypatch.setattr(failure_store, "get_artifact_store", lambda: store)
+
+    def failing(doc_name, document_bytes, index_name, deployment_name):
+        raise pipeline.DocumentProcessingError(doc_name, "embed", TimeoutError("slow"),
+                                               {"index_name": index_name, "deployment_name": deployment_name})
+
+    monkeypatch.setattr(pipeline, "process_or_resume", failing)
+    pipeline.write_shadow_copy("knowledge-docs/a.pdf", b"%PDF", "docs-v2", "large")
+    assert failure_store.get_failure("knowledge-docs/a.pdf", "docs-v2")["stage"] == "embed"
+
+def test_resume_empty_document_after_failed_delete(store, monkeypatch):
+    import failure_store
+
+    monkeypatch.setattr(failure_store, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(pipeline, "get_near_duplicate_index", lambda index_name, deployment_name: None)
+    monkeypatch.setattr(pipeline, "analyze_document_cached", lambda document_bytes: "")
+    deletes = []
+
+    def flaky_delete(doc_name, chunk_indexes, index_name=None):
+        deletes.append(list(chunk_indexes))
+        if len(deletes) == 1:
+            raise ConnectionError("connection reset")
+
+    monkeypatch.setattr(pipeline, "delete_stale_chunks", flaky_delete)
+
+    with pytest.raises(failure_store.DocumentProcessingError) as failure:
+        pipeline.process_or_resume("knowledge-docs/blank.pdf", b"%PDF", "docs", "ada")
+    assert failure.value.stage == "index"
+    failure_store.record_failure(failure.value)
+
+    # Resumes from the saved index-stage artifacts without reading the document again
+    record = failure_store.get_failure("knowledge-docs/blank.pdf", "docs")
+    assert pipeline.resume_document(record["fileName"], record["stage"], failure_store.load_artifacts(record)) == 0
+    assert deletes == [[], []]
+
+class FakeEmbeddingsClient:
+    """Returns a vector of each input's length; fails the request numbered fail_request"""
+    def __init__(self, fail_request=None):
+        self.inputs = []
+        self.fail_request = fail_request
+        self.embeddings = self
+
+    def create(self, input, model):
+        from types import SimpleNamespace
+
+        self.inputs.append(list(input))
+        if len(self.inputs) == self.fail_request:
+            raise TimeoutError("embeddings timed out")
+        return SimpleNamespace(data=[SimpleNamespace(index=i, embedding=[float(len(text))])
+                                     for i, text in enumerate(input)])
+
+def test_resume_reuses_vectors_embedded_before_the_failed_request(store, monkeypatch):
+    import failure_store
+
+    monkeypatch.setattr(failure_store, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(pipeline, "get_near_duplicate_index", lambda index_name, deployment_name: None)
+    monkeypatch.setattr(pipeline, "EMBEDDING_BATCH_SIZE", 2)
+    monkeypatch.setattr(pipeline, "delete_stale_chunks", lambda doc_name, chunk_indexes, index_name=None: None)
+    uploaded = {}
+    monkeypatch.setattr(pipeline, "add_chunks_to_search_index",
+                        lambda doc_name, chunks, embeddings, index_name=None, chunk_indexes=None:
+                        uploaded.update(zip(chunk_indexes, embeddings)))
+    chunks = [f"chunk {i} " + "x" * i for i in range(5)]
+
+    client = FakeEmbeddingsClient(fail_request=2)
+    monkeypatch.setattr(pipeline, "get_openai_client", lambda: client)
+    with pytest.raises(failure_store.DocumentProcessingError) as failure:
+        pipeline.index_chunks("knowledge-docs/a.pdf", chunks, 0, {"index_name": "docs", "deployment_name": "ada"})
+    assert failure.value.stage == "embed"
+    assert failure.value.artifacts["chunk_indexes"] == [0, 1]
+    assert not hasattr(failure.value.cause, "partial_vectors")
+
+    client = FakeEmbeddingsClient()
+    monkeypatch.setattr(pipeline, "get_openai_client", lambda: client)
+    assert pipeline.resume_document("knowledge-docs/a.pdf", "embed", failure.value.artifacts) == 5
+    assert client.inputs == [chunks[2:4], chunks[4:]]
+    assert uploaded == {i: [float(len(chunk))] for i, chunk in enumerate(chunks)}
+
+def test_search_client_reports_throttled_attempts_the_sdk_retries(monkeypatch):
+    import functools
+
+    import requests
+    from azure.core.pipeline.transport import HttpTransport, RequestsTransportResponse
+    from azure.search.documents import SearchClient
+
+    import concurrency
+
+    class ThrottlingTransport(HttpTransport):
+        """Answers 429 twice, then an empty result"""
+        def __init__(self):
+            self.sent = 0
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def open(self):
+            pass
+
+        def close(self):
+            pass
+
+        def send(self, request, **kwargs):
+            self.sent += 1
+            response = requests.Response()
+            response.status_code = 429 if self.sent <= 2 else 200
+            response.headers.update({"Content-Type": "application/json", "Retry-After": "0"})
+            response._content = b'{"value": []}'
+            return RequestsTransportResponse(request, response)
+
+    limit = concurrency.AdaptiveLimit("index", 8, latency_sensitive=False)
+    monkeypatch.setattr(concurrency, "_limiters", {"index": limit})
+    monkeypatch.setattr(pipeline, "SearchClient", functools.partial(SearchClient, transport=ThrottlingTransport()))
+    monkeypatch.setenv("AZURE_AISEARCH_ENDPOINT", "https://search.example.net")
+    monkeypatch.setenv("AZURE_AISEARCH_KEY", "key")
+
+    pipeline.delete_stale_chunks("knowledge-docs/a.pdf", [], "docs")
+    assert limit.metrics()["throttled"] == 2
+    assert limit.metrics()["limit"] == 2
+
+def test_document_slot_timeout_is_recorded(store, monkeypatch):
+    import hashlib
+    from types import SimpleNamespace
+
+    import concurrency
+    import failure_store
+
+    monkeypatch.setattr(failure_store, "get_artifact_store", lambda: store)
+    monkeypatch.setattr(pipeline, "resolve_write_targets", lambda: [("docs", "ada")])
+    monkeypatch.setattr(pipeline, "DOCUMENT_SLOT_TIMEOUT_SECONDS", 0.01)
+    busy = concurrency.AdaptiveLimit("documents", 1, latency_sensitive=False)
+    busy.in_flight = 1
+    monkeypatch.setattr(concurrency, "_limiters", {"documents": busy})
+    blob = SimpleNamespace(name="knowledge-docs/a.pdf", length=4, read=lambda: b"%PDF")
+    trigger = pipeline.process_uploaded_document.build().get_user_function()
+
+    with pytest.raises(failure_store.DocumentProcessingError) as failure:
+        trigger(blob)
+    assert isinstance(failure.value.cause, TimeoutError)
+    record = failure_store.get_failure("knowledge-docs/a.pdf", "docs")
+    assert record["stage"] == "read"
+    assert failure_store.load_artifacts(record)["content_hash"] == hashlib.sha256(b"%PDF").hexdigest()
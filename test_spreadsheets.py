@@ -0,0 +1,35 @@
+import io
+from datetime import datetime
+
+import openpyxl
+import xlrd
+from xlrd.sheet import Cell
+
+from spreadsheets import iter_sheet_chunks, iter_spreadsheet_chunks, xls_cell_value
+
+def test_chunks_stay_within_budget_including_header():
+    rows = [("id", "name", "notes")] + [(i, "x" * 20, "y" * 30) for i in range(50)]
+    chunks = list(iter_sheet_chunks("Orders", rows, max_chars=400))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 400 for chunk in chunks)
+    assert all(chunk.splitlines()[1] == "id | name | notes" for chunk in chunks)
+
+def test_wide_row_is_split_between_cells():
+    rows = [("id", "body", "extra"), (1, "z" * 900, "w" * 100)]
+    chunks = list(iter_sheet_chunks("Notes", rows, max_chars=400))
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 400 for chunk in chunks)
+    assert "".join(chunk.splitlines()[2] for chunk in chunks).count("z") == 900
+
+def test_xlsx_dates_and_header():
+    workbook = openpyxl.Workbook()
+    workbook.active.append(["id", "when"])
+    workbook.active.append([1, datetime(2024, 1, 2)])
+    data = io.BytesIO()
+    workbook.save(data)
+    assert list(iter_spreadsheet_chunks("book.xlsx", data.getvalue())) == [
+        "Sheet: Sheet (rows 2-2)\nid | when\n1 | 2024-01-02T00:00:00"]
+
+def test_xls_date_cells_become_datetimes():
+    assert xls_cell_value(Cell(xlrd.XL_CELL_DATE, 45000.0), 0) == datetime(2023, 3, 15)
+    assert xls_cell_value(Cell(xlrd.XL_CELL_NUMBER, 45000.0), 0) == 45000.0
@@ -2,6 +2,7 @@ import os
 from azure.core.credentials import AzureKeyCredential
 from azure.search.documents import SearchClient
 from openai import AzureOpenAI
+from index_pointer import resolve_embedding_deployment, resolve_index_name
 
 # Load environment variables from local.settings.json
 import json
@@ -20,7 +21,7 @@ openai_client = AzureOpenAI(
 # Create search client
 search_client = SearchClient(
     endpoint=os.environ["AZURE_AISEARCH_ENDPOINT"],
-    index_name=os.environ["SEARCH_INDEX_NAME"],
+    index_name=resolve_index_name(),
     credential=AzureKeyCredential(os.environ["AZURE_AISEARCH_KEY"])
 )
 
@@ -28,7 +29,7 @@ search_client = SearchClient(
 query = "Enter your search query here"
 response = openai_client.embeddings.create(
     input=query,
-    model=os.environ["OPENAI_EMBEDDING_DEPLOYMENT_NAME"]
+    model=resolve_embedding_deployment()
 )
 vector = response.data[0].embedding
 